@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from time import time, sleep
+
+SIZE_UNITS = {'': 1, 'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30, 't': 2 ** 40}
+
+
+def parse_size(text: str):
+    """Convert a size such as '500M', '20G' or plain bytes into bytes"""
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$', str(text).lower())
+    if m is None:
+        raise ValueError("Invalid size: {}".format(text))
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2)])
+
+
+class ArtefactStore:
+    """
+    Content-addressed store of downloaded and extracted files.
+
+        root/
+            blobs/ab/ab12...ef.xlsx     file named by the sha256 of its content
+            manifests/TABLE.json        snapshots of the files a table was built from
+            urls.json                   last download of every url (for conditional GET)
+
+    Identical files are kept once, whatever table or url they came from. A
+    snapshot is marked good once its table was stored and verified; the most
+    recent good snapshot (and the newest snapshot) of every table is pinned,
+    everything else is evicted least recently used first when the store
+    exceeds its budget, or when older than max_age.
+
+    Several crawler processes (e.g. local workers) may share a store: blobs
+    are written under unique temporary names, and urls.json and the
+    manifests are updated under a lock file.
+    """
+
+    def __init__(self, root: str = os.path.join('data', 'store'), budget: int = None, max_age: float = None,
+                 lock_timeout: float = 60, logger_name: str = 'crawler'):
+        self.root = root
+        self.budget = budget
+        self.max_age = max_age
+        self.lock_timeout = lock_timeout
+        self._logger = logging.getLogger(logger_name)
+        for d in ('blobs', 'manifests'):
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    # -- blobs --
+
+    def put(self, path: str):
+        """
+        Move a file into the store.
+
+        :return: path of the blob holding the file's content
+        """
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        _, ext = os.path.splitext(path)
+        blob = os.path.join(self.root, 'blobs', digest[:2], digest + ext.lower())
+
+        if os.path.exists(blob):
+            os.remove(path)
+        else:
+            # another process may be storing the same content right now,
+            # whichever replace comes last leaves identical bytes
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp_blob = '{}.{}.tmp'.format(blob, uuid.uuid4().hex)
+            shutil.move(path, tmp_blob)
+            os.replace(tmp_blob, blob)
+        self.touch(blob)
+        return blob
+
+    def touch(self, blob: str):
+        """Mark blob as recently used"""
+        os.utime(blob)
+
+    def _blobs(self):
+        for dirpath, _, files in os.walk(os.path.join(self.root, 'blobs')):
+            for f in files:
+                if not f.endswith('.tmp'):
+                    yield os.path.join(dirpath, f)
+
+    # -- urls --
+
+    def _read_json(self, path: str, default):
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        return default
+
+    def _write_json(self, path: str, data):
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @contextmanager
+    def _lock(self, name: str):
+        """
+        Exclusive lock across processes for read-modify-write of a json file.
+        A lock older than lock_timeout is left from a crashed process and
+        broken.
+        """
+        lock_file = os.path.join(self.root, name + '.lock')
+        while True:
+            try:
+                os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time() - os.path.getmtime(lock_file) > self.lock_timeout:
+                        self._logger.warning('Breaking stale lock {}'.format(lock_file))
+                        os.remove(lock_file)
+                        continue
+                except FileNotFoundError:
+                    continue
+                sleep(0.01)
+        try:
+            yield
+        finally:
+            os.remove(lock_file)
+
+    def lookup_url(self, url: str):
+        """
+        Last download of url: dict with name, blob, spreadsheets (blobs
+        extracted from it), etag and last_modified; None if unknown or evicted.
+        """
+        entry = self._read_json(os.path.join(self.root, 'urls.json'), {}).get(url)
+        if entry is None or not all(os.path.exists(b) for b in [entry["blob"]] + entry["spreadsheets"]):
+            return None
+        return entry
+
+    def record_url(self, url: str, name: str, blob: str, spreadsheets: list, headers=None):
+        headers = headers or {}
+        urls_file = os.path.join(self.root, 'urls.json')
+        with self._lock('urls'):
+            urls = self._read_json(urls_file, {})
+            urls[url] = {"name": name,
+                         "blob": blob,
+                         "spreadsheets": spreadsheets,
+                         "etag": headers.get('ETag'),
+                         "last_modified": headers.get('Last-Modified')}
+            self._write_json(urls_file, urls)
+
+    # -- manifests --
+
+    def _manifest_file(self, table: str):
+        return os.path.join(self.root, 'manifests', table + '.json')
+
+    def snapshots(self, table: str):
+        """Snapshots of table, newest first"""
+        return self._read_json(self._manifest_file(table), [])
+
+    def record(self, table: str, files: list):
+        """
+        Record the files (list of dicts with at least a 'blob' key) a table
+        is about to be built from as its newest snapshot, unless the newest
+        snapshot already lists the same files.
+        """
+        with self._lock('manifests'):
+            snapshots = self.snapshots(table)
+            if snapshots and snapshots[0]["files"] == files:
+                return
+            snapshots.insert(0, {"created": datetime.now().isoformat(), "good": False, "files": files})
+            self._write_json(self._manifest_file(table), snapshots)
+
+    def mark_good(self, table: str):
+        """Mark the newest snapshot of table as stored and verified"""
+        with self._lock('manifests'):
+            snapshots = self.snapshots(table)
+            if snapshots:
+                snapshots[0]["good"] = True
+                self._write_json(self._manifest_file(table), snapshots)
+
+    def pinned(self):
+        """Blobs of the newest and the most recent good snapshot of every table"""
+        pinned = set()
+        for f in os.listdir(os.path.join(self.root, 'manifests')):
+            if not f.endswith('.json'):
+                continue
+            snapshots = self.snapshots(os.path.splitext(f)[0])
+            keep = snapshots[:1] + [s for s in snapshots if s["good"]][:1]
+            pinned.update(entry["blob"] for snapshot in keep for entry in snapshot["files"])
+        return pinned
+
+    def evict(self):
+        """
+        Remove unpinned blobs older than max_age, then least recently used
+        unpinned blobs until the store fits its budget. Snapshots referring
+        to removed blobs are dropped. Runs under the manifests lock, so no
+        snapshot is recorded meanwhile on a blob about to be removed.
+
+        :return: number of bytes freed
+        """
+        with self._lock('manifests'):
+            pinned = self.pinned()
+            blobs = sorted((os.path.getmtime(b), os.path.getsize(b), b) for b in self._blobs())
+            total = sum(size for _, size, _ in blobs)
+            now = time()
+            freed = 0
+            for mtime, size, blob in blobs:
+                expired = self.max_age is not None and now - mtime > self.max_age
+                over_budget = self.budget is not None and total - freed > self.budget
+                if not (expired or over_budget):
+                    continue
+                if blob in pinned:
+                    continue
+                os.remove(blob)
+                freed += size
+                self._logger.debug('Evicted {} ({} bytes)'.format(os.path.basename(blob), size))
+
+            if self.budget is not None and total - freed > self.budget:
+                self._logger.warning('Artefact store holds {} bytes of pinned files, over its budget of {}'.format(
+                    total - freed, self.budget))
+
+            for f in os.listdir(os.path.join(self.root, 'manifests')):
+                if f.endswith('.json'):
+                    table = os.path.splitext(f)[0]
+                    snapshots = [s for s in self.snapshots(table)
+                                 if all(os.path.exists(entry["blob"]) for entry in s["files"])]
+                    self._write_json(self._manifest_file(table), snapshots)
+        return freed
@@ -0,0 +1,133 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# columns holding business (BIN) or individual (IIN) identification numbers
+KEY_COLUMNS = ('BIN', 'owner_IIN')
+
+INDEX_DTYPE = np.dtype([('key', '<i8'), ('row', '<i4'), ('col', '<i2')])
+# sorted keys are saved on their own, searchsorted needs them contiguous
+ROW_DTYPE = np.dtype([('row', '<i4'), ('col', '<i2')])
+
+
+def _keys(values: pd.Series):
+    """
+    BIN/IIN strings as int64, -1 where missing or malformed. Up to 12
+    digits are accepted: a BIN stored as a number in the sheet loses its
+    leading zeros, the int64 key is the same either way.
+    """
+    values = values.astype(object).where(values.notnull(), '').astype(str).str.strip()
+    valid = values.str.match(r'^\d{1,12}$')
+    keys = np.full(len(values), -1, dtype=np.int64)
+    keys[valid.values] = values[valid].astype(np.int64).values
+    return keys
+
+
+def build_table_index(table_name: str, data, key_cols: list = None,
+                      index_dir: str = os.path.join('data', 'index')):
+    """
+    Write the BIN/IIN index of a loaded table: the sorted keys in
+    index_dir/TABLE.npy, their (row offset, column) in TABLE.rows.npy and
+    TABLE.json naming the columns. Row offsets count rows of the table in
+    load order.
+
+    :param data: pandas.DataFrame or iterable of DataFrame batches
+                 (e.g. crawler.handoff.ArrowFrames)
+    :param list key_cols: Columns to index, by default those of KEY_COLUMNS
+                          present in the table
+    :return: number of indexed keys, None if the table has no key columns
+    """
+    batches = [data] if isinstance(data, pd.DataFrame) else data
+    parts = []
+    offset = 0
+    for frame in batches:
+        if key_cols is None:
+            key_cols = [col for col in KEY_COLUMNS if col in frame.columns]
+        if not key_cols:
+            return None
+        for col_no, col in enumerate(key_cols):
+            keys = _keys(frame[col])
+            found = np.flatnonzero(keys >= 0)
+            part = np.empty(len(found), dtype=INDEX_DTYPE)
+            part['key'] = keys[found]
+            part['row'] = found + offset
+            part['col'] = col_no
+            parts.append(part)
+        offset += len(frame)
+
+    index = np.concatenate(parts) if parts else np.empty(0, dtype=INDEX_DTYPE)
+    index.sort(order=['key', 'row'])
+
+    rows = np.empty(len(index), dtype=ROW_DTYPE)
+    rows['row'] = index['row']
+    rows['col'] = index['col']
+
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, table_name + '.json'), 'w') as f:
+        json.dump({"columns": key_cols, "rows": offset, "keys": len(index)}, f, indent=2)
+    # the keys file is replaced last, readers re-map a table when it changes
+    for name, array in ((table_name + '.rows.npy', rows), (table_name + '.npy', index['key'])):
+        tmp_file = os.path.join(index_dir, '.' + name)
+        np.save(tmp_file, np.ascontiguousarray(array))
+        os.replace(tmp_file, os.path.join(index_dir, name))
+    return len(index)
+
+
+class BinIndex:
+    """
+    Lookup of BIN/IIN across all indexed tables without a database round
+    trip. Table indexes are memory-mapped and re-mapped when rebuilt.
+
+        >>> idx = BinIndex()
+        >>> idx.tables('123456789012')
+        ['CR_KGDGOV_BANKRUPT', 'CR_STATGOV_COMPANIES']
+        >>> idx.lookup('123456789012')
+        {'CR_KGDGOV_BANKRUPT': [('BIN', 1042)], 'CR_STATGOV_COMPANIES': [('BIN', 88212)]}
+    """
+
+    def __init__(self, index_dir: str = os.path.join('data', 'index')):
+        self.index_dir = index_dir
+        self._tables = {}  # table -> (mtime, keys, rows, columns)
+
+    def _refresh(self):
+        if not os.path.isdir(self.index_dir):
+            return
+        for f in os.listdir(self.index_dir):
+            if not f.endswith('.npy') or f.endswith('.rows.npy') or f.startswith('.'):
+                continue
+            table = f[:-len('.npy')]
+            path = os.path.join(self.index_dir, f)
+            # a rebuilt index replaces the file: new inode even within the mtime resolution
+            stat = os.stat(path)
+            mtime = (stat.st_mtime_ns, stat.st_ino)
+            if table not in self._tables or self._tables[table][0] != mtime:
+                with open(os.path.join(self.index_dir, table + '.json'), 'r') as meta:
+                    columns = json.load(meta)["columns"]
+                self._tables[table] = (mtime, np.load(path, mmap_mode='r'),
+                                       np.load(os.path.join(self.index_dir, table + '.rows.npy'), mmap_mode='r'),
+                                       columns)
+
+    def lookup(self, key, refresh: bool = True):
+        """
+        All occurrences of a BIN/IIN.
+
+        :param key: 12-digit BIN or IIN (str or int)
+        :param bool refresh: Pick up rebuilt table indexes first
+        :return: dict of table -> list of (column, row offset)
+        """
+        if refresh:
+            self._refresh()
+        key = int(key)
+        result = {}
+        for table, (_, keys, rows, columns) in self._tables.items():
+            lo = keys.searchsorted(key, side='left')
+            hi = keys.searchsorted(key, side='right')
+            if hi > lo:
+                result[table] = [(columns[int(col)], int(row)) for row, col in rows[lo:hi]]
+        return result
+
+    def tables(self, key, refresh: bool = True):
+        """Names of the tables (lists) a BIN/IIN appears in"""
+        return sorted(self.lookup(key, refresh))
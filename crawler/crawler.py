@@ -1,21 +1,39 @@
+import atexit
+import itertools
 import os
 import sys
 import logging
 import logging.config
 from datetime import timedelta
-from time import time
+from time import time, sleep
 
+import pandas as pd
+import requests
 from slackclient import SlackClient
 
-from crawler.dbfill import DbFill
-from crawler.queuemanager import queue_jobs, download_extract_files, prepare_data
+from crawler.artefacts import ArtefactStore, parse_size
+from crawler.binindex import KEY_COLUMNS, build_table_index
+from crawler.daemon import Daemon, Scheduler, parse_interval
+from crawler.dbfill import DbFill, LoadChecksum
+from crawler.governor import MemoryGovernor
+from crawler.handoff import ArrowFrames, ParsePool, WorkerLost, arrow_available
+from crawler.journal import RunJournal
+from crawler.probe import probe_table
+from crawler.sqlldr import SqlLoader
+from crawler.queuemanager import queue_jobs, download_extract_files, prepare_data, iter_prepared_data, \
+    WorkbookCache
+from crawler.workqueue import ClaimQueue
 from crawler.utils import make_log_dir, MsgCounterHandler, internet_on, get_bot_user_token, DummySlackClient, \
-    filter_log_count
+    filter_log_count, get_settings, start_queue_logging, post_async
+
+log_listener = None
 
 
 def init_logger():
     global root_path
     global logger
+    global counth
+    global log_listener
     global slack_client
     global slack_channel
 
@@ -28,38 +46,42 @@ def init_logger():
     # set slack bot config path
     slack_config_file = os.path.join('conf', 'slack.conf')
 
-    if os.path.exists(log_config_file):
-        # create logger
-        make_log_dir(log_config_file)
-        logging.config.fileConfig(log_config_file)
-        logger = logging.getLogger('crawler')
-        counth = MsgCounterHandler()
-        counth.setLevel(logging.DEBUG)
-        logger.addHandler(counth)
+    if log_listener is None:
+        if os.path.exists(log_config_file):
+            # create logger
+            make_log_dir(log_config_file)
+            logging.config.fileConfig(log_config_file, disable_existing_loggers=False)
+            logger = logging.getLogger('crawler')
 
-    else:
-        # create a backup logger
-        logger = logging.getLogger('crawler')
-        logger.setLevel(logging.DEBUG)
+        else:
+            # create a backup logger
+            logger = logging.getLogger('crawler')
+            logger.setLevel(logging.DEBUG)
+
+            # create console handler and set level to debug
+            ch = logging.StreamHandler(stream=sys.stdout)
+            ch.setLevel(logging.DEBUG)
+
+            # create formatter
+            formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
 
-        # create console handler and set level to debug
-        ch = logging.StreamHandler(stream=sys.stdout)
-        ch.setLevel(logging.DEBUG)
+            # add formatter to ch
+            ch.setFormatter(formatter)
+
+            # add ch to logger
+            logger.addHandler(ch)
 
         # create a messages counter handler
         counth = MsgCounterHandler()
         counth.setLevel(logging.DEBUG)
 
-        # create formatter
-        formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
-
-        # add formatter to ch
-        ch.setFormatter(formatter)
-
-        # add ch to logger
-        logger.addHandler(ch)
-        logger.addHandler(counth)
-        logger.warning('Using default console logger')
+        # Handlers doing I/O run in a listener thread, the crawler and DbFill
+        # loggers only put records on a queue (and count them)
+        log_listener = start_queue_logging(logger.handlers[:], counth,
+                                           {'crawler': logging.DEBUG, 'DbFill': logging.INFO})
+        atexit.register(log_listener.stop)
+        if not os.path.exists(log_config_file):
+            logger.warning('Using default console logger')
 
     if os.path.exists(slack_config_file):
         slack_token, slack_channel = get_bot_user_token(slack_config_file)
@@ -74,51 +96,456 @@ def init_logger():
         logger.debug('Dummy Slack bot initialized')
 
 
-def run():
-    init_logger()
-    if not internet_on():
-        logger.error("No internet connection.")
-        return
+class _StreamedTable:
+    """
+    Sheets of a table streamed from iter_prepared_data into the loader.
+    Counts the rows passing through and keeps the (small) BIN/IIN columns
+    for the index. The first sheet is parsed right away, so that a table
+    failing on it is rejected before it is purged.
+    """
 
-    t0 = time()
+    def __init__(self, frames, key_cols: list = None):
+        frames = iter(frames)
+        first = next(frames, None)
+        self._frames = itertools.chain([first] if first is not None else [], frames)
+        self._key_cols = key_cols
+        self.rows = 0
+        self.key_frames = []
 
-    logger.info("Downloading and Extracting... ")
-    job_queue = queue_jobs()  # Get jobs
-    job_queue = download_extract_files(job_queue)  # Download, extract, update paths
+    def __len__(self):
+        return self.rows
 
-    db = DbFill(os.path.join('conf', 'database.ini'))
+    def __iter__(self):
+        for frame in self._frames:
+            self.rows += len(frame)
+            key_cols = self._key_cols or [col for col in KEY_COLUMNS if col in frame.columns]
+            self.key_frames.append(frame[key_cols].copy())
+            yield frame
 
-    for table_name, table_data in job_queue.items():
-        try:
-            db.purge(table_name)
-            logger.info('{}: Table cleared!'.format(table_name))
 
-            data = prepare_data(table_data, table_name)
-            data_rows = len(data)
+def process_table(db: DbFill, table_name: str, table_data: dict, journal: RunJournal = None,
+                  workbooks: WorkbookCache = None, update_fingerprints: bool = False, parse_pool: ParsePool = None,
+                  governor: MemoryGovernor = None, owned=None, loader: SqlLoader = None):
+    """
+    Load a single (already downloaded) table into the database.
+
+    If a journal is given, stages completed in an earlier (failed) run are
+    skipped: a parsed table is read back from its pickle, a loaded table is
+    only verified and a verified table is not touched at all.
+
+    If a WorkbookCache is given, the table's workbooks are taken from it and
+    released once the table is done.
+
+    Before parsing, the layout of every sheet is probed against the stored
+    fingerprint (see crawler.probe); update_fingerprints accepts the current
+    layouts as the new reference instead.
+
+    If the table was submitted to a ParsePool, the parsed table is taken
+    from the worker's memory-mapped Arrow file instead of parsing here.
+
+    Once verified, the table's BIN/IIN columns are indexed (see
+    crawler.binindex) unless disabled in the [index] section.
+
+    If a SqlLoader is given (see open_sql_loader), the table is written to a
+    data file in its store and loaded direct-path by SQL*Loader instead of
+    INSERTs (see DbFill.bulk_load).
+
+    If a MemoryGovernor is given, a table parsed here that does not fit the
+    memory headroom is parsed and loaded sheet by sheet instead of as a
+    whole, and loads under memory pressure go in small batches.
+    NOTE: Such a table is purged once its first sheet is parsed, the others
+          are parsed while loading. A parse error in a later sheet rolls the
+          inserted rows back, but leaves the table empty until the next
+          successful run (TRUNCATE cannot be rolled back).
+
+    owned is called right before the table is purged; if it returns False
+    (e.g. the work queue claim on the table was lost to another worker)
+    the table is left alone.
+
+    :return: True if the table was stored and passed the integrity check
+    """
+    if governor is None:
+        return _process_table(db, table_name, table_data, journal, workbooks, update_fingerprints, parse_pool,
+                              owned=owned, loader=loader)
+    with governor.track(table_name, table_data):
+        return _process_table(db, table_name, table_data, journal, workbooks, update_fingerprints, parse_pool,
+                              governor, owned, loader)
+
+
+def _process_table(db: DbFill, table_name: str, table_data: dict, journal: RunJournal = None,
+                   workbooks: WorkbookCache = None, update_fingerprints: bool = False, parse_pool: ParsePool = None,
+                   governor: MemoryGovernor = None, owned=None, loader: SqlLoader = None):
+    data = None
+    try:
+        if journal is not None and journal.done(table_name, 'verified'):
+            logger.info('{}: Already stored in database, resuming'.format(table_name))
+            return True
+
+        if journal is not None and journal.done(table_name, 'loaded'):
+            logger.info('{}: Already loaded, resuming'.format(table_name))
+            loaded = journal.artefacts(table_name, 'loaded')
+            data_rows = loaded["rows"]
+            checksum = LoadChecksum.from_dict(loaded["checksum"])
+        else:
+            parsed = journal.artefacts(table_name, 'parsed') if journal is not None else {}
+            if parsed and os.path.exists(parsed["file"]):
+                logger.info('{}: Already parsed, resuming'.format(table_name))
+                data = read_parsed(parsed["file"])
+            elif parse_pool is not None and table_name in parse_pool:
+                data = worker_result(parse_pool, table_name, journal)
+
+            # parsed here if not parsed before or the parse worker was lost
+            if data is None and governor is not None and not governor.admit(table_name, table_data):
+                probe_table(table_data, table_name, update=update_fingerprints, workbooks=workbooks)
+                data = _StreamedTable(iter_prepared_data(table_data, table_name, workbooks=workbooks),
+                                      table_data.get("key_cols"))
+            elif data is None:
+                probe_table(table_data, table_name, update=update_fingerprints, workbooks=workbooks)
+                data = prepare_data(table_data, table_name, workbooks=workbooks)
+                if journal is not None:
+                    os.makedirs(table_data["store"], exist_ok=True)
+                    parsed_file = os.path.join(table_data["store"], '.parsed.pkl')
+                    data.to_pickle(parsed_file)
+                    journal.mark(table_name, 'parsed', file=parsed_file, rows=len(data))
             structure = table_data["structure"]
 
-            # conversion to list of dictionaries (see https://stackoverflow.com/a/29815523/8510370)
-            data = list(data.T.to_dict().values())
-            logger.debug("{}: Storing to database...".format(table_name))
-            db.fill_main_storage(table_name, structure, data, "utf-8")
+            if owned is not None and not owned():
+                logger.error('{}: No longer owned, not loading'.format(table_name))
+                return False
+            try:
+                db.purge(table_name)
+            except Exception as e:
+                logger.error('{}: Table not cleared, not loading: {}'.format(table_name, e))
+                return False
+            logger.info('{}: Table cleared!'.format(table_name))
 
-            # check for successful write to database
-            logger.debug("{}: Checking row integrity...".format(table_name))
-            db_rows = db.get_num_rows(table_name)
-            if int(db_rows) == data_rows:
-                logger.info("{}: Successfully stored in database!".format(table_name))
+            # DataFrame is encoded batch by batch, categorical columns stay encoded until bind time
+            logger.debug("{}: Storing to database...".format(table_name))
+            batch_size = governor.batch_size(50000) if governor is not None else 50000
+            if loader is not None:
+                checksum = db.bulk_load(table_name, structure, data, table_data["store"], batch_size=batch_size,
+                                        loader=loader)
             else:
-                logger.error("{}: Row count mismatch, something went wrong.".format(table_name))
-        except Exception as e:
-            logger.error("{}: {}".format(table_name, e))
+                checksum = db.fill_main_storage(table_name, structure, data, "utf-8", batch_size=batch_size)
+            # counted after loading, a streamed table is only parsed while it is loaded
+            data_rows = len(data)
+            if checksum is None:
+                logger.error("{}: Load failed.".format(table_name))
+                return False
+            if journal is not None:
+                journal.mark(table_name, 'loaded', rows=data_rows, checksum=checksum.to_dict())
+
+        # check for successful write to database
+        logger.debug("{}: Checking row integrity...".format(table_name))
+        if checksum.rows != data_rows:
+            logger.error("{}: Row count mismatch, something went wrong.".format(table_name))
+        elif get_settings('verify', mode='rowcount')["mode"] == 'checksum' and \
+                not db.verify_checksum(table_name, checksum):
+            logger.error("{}: Checksum mismatch, something went wrong.".format(table_name))
+        else:
+            logger.info("{}: Successfully stored in database!".format(table_name))
+            if data is None:
+                # resumed after loading, index the parsed copy the table was loaded from
+                parsed = journal.artefacts(table_name, 'parsed')
+                if parsed and os.path.exists(parsed["file"]):
+                    data = read_parsed(parsed["file"])
+                else:
+                    logger.warning('{}: No parsed copy left, BIN/IIN index not updated'.format(table_name))
+            if data is not None:
+                index_table(table_name, table_data, data.key_frames if isinstance(data, _StreamedTable) else data)
+            if journal is not None:
+                journal.mark(table_name, 'verified', rows=data_rows)
+            remove_parsed(table_name, data, journal)
+            return True
+
+        if journal is not None:
+            # reload on the next --resume
+            journal.reset(table_name, 'loaded')
+    except Exception as e:
+        logger.error("{}: {}".format(table_name, e))
+    finally:
+        if workbooks is not None:
+            workbooks.release(table_data)
+        if isinstance(data, ArrowFrames):
+            data.close()
+    return False
+
+
+def worker_result(parse_pool: ParsePool, table_name: str, journal: RunJournal = None):
+    """
+    ArrowFrames of a table parsed by a parse worker, None if the worker died
+    (the table is then parsed in-process)
+    """
+    try:
+        data = parse_pool.result(table_name)
+    except WorkerLost as e:
+        logger.warning('{}, parsing in-process'.format(e))
+        return None
+    logger.debug('{}: Parsed by worker into {}'.format(table_name, data.path))
+    if journal is not None:
+        journal.mark(table_name, 'parsed', file=data.path, rows=len(data))
+    return data
+
+
+def read_parsed(parsed_file: str):
+    """Parsed copy of a table: ArrowFrames of a parse worker's Arrow file or the pickled DataFrame"""
+    if parsed_file.endswith('.arrow'):
+        return ArrowFrames(parsed_file)
+    return pd.read_pickle(parsed_file)
+
+
+def remove_parsed(table_name: str, data, journal: RunJournal = None):
+    """Delete the parsed copy (pickle or Arrow file) of a table once it is verified"""
+    files = set()
+    if isinstance(data, ArrowFrames):
+        data.close()
+        files.add(data.path)
+    if journal is not None:
+        files.add(journal.artefacts(table_name, 'parsed').get("file"))
+    for f in files:
+        if f and os.path.exists(f):
+            os.remove(f)
+            logger.debug('{}: Removed {}'.format(table_name, f))
+
+
+def index_table(table_name: str, table_data: dict, data):
+    """Rebuild the BIN/IIN index of a loaded table, configured in the [index] section of conf/crawler.conf"""
+    settings = get_settings('index', enabled=True, dir=os.path.join('data', 'index'))
+    if not settings["enabled"]:
+        return
+    try:
+        keys = build_table_index(table_name, data, table_data.get("key_cols"), settings["dir"])
+        if keys is not None:
+            logger.debug('{}: Indexed {} BIN/IIN entries'.format(table_name, keys))
+    except Exception as e:
+        # the index is a by-product, the table itself is stored fine
+        logger.warning('{}: BIN/IIN index not updated: {}'.format(table_name, e))
+
+
+def open_sql_loader():
+    """
+    SqlLoader if the [load] section of conf/crawler.conf selects the
+    direct-path method = sqlldr, None for INSERTs. Opened once per run, so
+    that a bad setting fails before any table is purged.
+
+    :raises ValueError: for an unknown method
+    """
+    settings = get_settings('load', method='insert', sqlldr='sqlldr', keep_files=False)
+    if settings["method"] == 'insert':
+        return None
+    if settings["method"] != 'sqlldr':
+        raise ValueError("Unknown load method: {}".format(settings["method"]))
+    return SqlLoader(settings["sqlldr"], keep_files=settings["keep_files"])
 
-    log_count = logger.handlers[2].level2count
-    end_msg = "`telecom_crawler` task completed\n" + \
+
+def open_artefact_store():
+    """ArtefactStore configured in the [store] section of conf/crawler.conf, None if disabled"""
+    settings = get_settings('store', enabled=True, root=os.path.join('data', 'store'), budget='10G', max_age='')
+    if not settings["enabled"]:
+        return None
+    return ArtefactStore(settings["root"], parse_size(settings["budget"]),
+                         parse_interval(settings["max_age"]) if settings["max_age"] else None)
+
+
+def open_governor():
+    """MemoryGovernor configured in the [memory] section of conf/crawler.conf, None without a budget"""
+    settings = get_settings('memory', budget='', expansion=10.0, pressure=0.8, small_batch=5000,
+                            history_file=os.path.join('data', 'memory_history.json'))
+    if not settings["budget"]:
+        return None
+    return MemoryGovernor(parse_size(settings["budget"]), settings["history_file"], settings["expansion"],
+                          settings["pressure"], settings["small_batch"])
+
+
+def open_parse_pool(job_queue: dict, update_fingerprints: bool = False, governor: MemoryGovernor = None):
+    """
+    ParsePool with the number of workers set in the [parse] section of
+    conf/crawler.conf, None to parse in-process. With a governor, only
+    tables fitting a worker's share of the memory headroom are submitted,
+    the others are left to process_table.
+    """
+    workers = get_settings('parse', workers=0)["workers"]
+    if governor is not None:
+        job_queue = governor.admit_all(job_queue, workers)
+    if workers <= 0 or not job_queue:
+        return None
+    if not arrow_available():
+        logger.warning('pyarrow is not installed, parsing in-process')
+        return None
+    return ParsePool(job_queue, workers, update_fingerprints)
+
+
+def report(t0: float, title: str = "`telecom_crawler` task completed", counts: dict = None):
+    """
+    Post end-of-run message with warning/error counts to Slack and stdout
+
+    :param dict counts: Snapshot of the message counts taken at the start of
+                        the run; only messages logged since are reported
+                        (the process may outlive a single run)
+    """
+    log_count = counth.level2count if counts is None else counth.since(counts)
+    end_msg = title + "\n" + \
               filter_log_count(log_count) + \
               "runtime: {}".format(timedelta(seconds=time() - t0))
-    slack_client.api_call(
+    # posted from a background thread, the run never waits for Slack
+    post_async(
+        slack_client,
         "chat.postMessage",
         channel=slack_channel,
         text=end_msg
     )
     print(end_msg.replace('`', ''))
+
+
+def run(resume: bool = False, update_fingerprints: bool = False):
+    """
+    Download, extract, parse and load every job in /jobs.
+
+    :param bool resume: Continue the previous run from its journal, only
+                        redoing the stages that did not complete
+    :param bool update_fingerprints: Store the current spreadsheet layouts
+                                     as reference instead of rejecting
+                                     tables whose layout changed
+    """
+    init_logger()
+    if not internet_on():
+        logger.error("No internet connection.")
+        return
+
+    t0 = time()
+
+    logger.info("Downloading and Extracting... ")
+    job_queue = queue_jobs()  # Get jobs
+    journal = RunJournal(resume=resume)
+    artefacts = open_artefact_store()
+    governor = open_governor()
+    loader = open_sql_loader()
+    # Download, extract, update paths
+    job_queue = download_extract_files(job_queue, journal=journal, artefacts=artefacts)
+
+    db = DbFill(os.path.join('conf', 'database.ini'))
+
+    parse_pool = open_parse_pool({table_name: table_data for table_name, table_data in job_queue.items()
+                                  if not journal.done(table_name, 'parsed')}, update_fingerprints, governor)
+    workbooks = WorkbookCache(job_queue)
+    for table_name, table_data in job_queue.items():
+        success = process_table(db, table_name, table_data, journal, workbooks, update_fingerprints, parse_pool,
+                                governor, loader=loader)
+        if success and artefacts is not None:
+            artefacts.mark_good(table_name)
+    workbooks.close()
+    if parse_pool is not None:
+        parse_pool.close()
+    if artefacts is not None:
+        artefacts.evict()
+
+    report(t0)
+
+
+def publish(queue_dir: str = os.path.join('jobs', 'queue')):
+    """Publish all jobs in /jobs as table-level work items for workers"""
+    init_logger()
+    job_queue = queue_jobs()
+    ClaimQueue(queue_dir).publish(job_queue)
+    logger.info("Published {} tables to {}".format(len(job_queue), queue_dir))
+
+
+def run_worker(queue_dir: str = os.path.join('jobs', 'queue'), lease: float = 300, poll: float = 10):
+    """
+    Worker mode: claim tables one at a time from a queue shared with other
+    crawler processes/hosts (see publish()) until no work is left.
+
+    :param str queue_dir: Queue directory, may be on shared storage
+    :param float lease: Seconds without heartbeat after which a claim is
+                        considered abandoned and re-queued
+    :param float poll: Seconds to wait while other workers still hold
+                       claims that might expire
+    """
+    init_logger()
+    if not internet_on():
+        logger.error("No internet connection.")
+        return
+
+    t0 = time()
+    loader = open_sql_loader()
+    queue = ClaimQueue(queue_dir, lease=lease)
+    logger.info("Worker {} started on {}".format(queue.worker_id, queue_dir))
+
+    db = DbFill(os.path.join('conf', 'database.ini'))
+    artefacts = open_artefact_store()
+    governor = open_governor()
+
+    while True:
+        item = queue.claim()
+        if item is None:
+            if not queue.has_claims():
+                break
+            # wait for other workers to finish (or their leases to expire)
+            sleep(poll)
+            continue
+
+        table_name, table_data = item
+        logger.info("{}: Claimed by {}".format(table_name, queue.worker_id))
+        with queue.keep_alive(table_name) as claim:
+            success = False
+            try:
+                table_queue = download_extract_files({table_name: table_data}, artefacts=artefacts)
+                success = process_table(db, table_name, table_queue[table_name], governor=governor,
+                                        owned=claim.owned, loader=loader)
+                if success and artefacts is not None:
+                    artefacts.mark_good(table_name)
+            except Exception as e:
+                logger.error("{}: {}".format(table_name, e))
+        queue.complete(table_name, success)
+
+    if artefacts is not None:
+        artefacts.evict()
+
+    report(t0, "`telecom_crawler` worker {} completed".format(queue.worker_id))
+
+
+def run_daemon():
+    """
+    Long-running mode: keeps the Oracle connection, HTTP connection pool,
+    Slack connection and job models warm and runs every job on its own
+    interval (see [schedule] in conf/crawler.conf). A local control
+    endpoint ([daemon] host/port) shows the runs in flight and queues a job
+    or table on demand.
+    """
+    init_logger()
+    if not internet_on():
+        logger.error("No internet connection.")
+        return
+
+    settings = get_settings('daemon', host='127.0.0.1', port=8765, tick=60)
+    schedule = get_settings('schedule', default='1d')
+    default_interval = parse_interval(schedule.pop('default'))
+    loader = open_sql_loader()
+    scheduler = Scheduler({job: parse_interval(interval) for job, interval in schedule.items()},
+                          default_interval)
+
+    db = DbFill(os.path.join('conf', 'database.ini'))
+    session = requests.Session()
+    artefacts = open_artefact_store()
+    governor = open_governor()
+
+    def execute(job_queue: dict):
+        t0 = time()
+        counts = dict(counth.level2count)
+        db.ensure_connected()
+        job_queue = download_extract_files(job_queue, session=session, artefacts=artefacts)
+        workbooks = WorkbookCache(job_queue)
+        try:
+            for table_name, table_data in job_queue.items():
+                success = process_table(db, table_name, table_data, workbooks=workbooks, governor=governor,
+                                        loader=loader)
+                if success and artefacts is not None:
+                    artefacts.mark_good(table_name)
+                yield table_name, success
+        finally:
+            workbooks.close()
+            if artefacts is not None:
+                artefacts.evict()
+        report(t0, "`telecom_crawler` {} completed".format(', '.join(job_queue)), counts)
+
+    Daemon(execute, scheduler, settings["host"], settings["port"], settings["tick"]).serve_forever()
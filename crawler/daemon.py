@@ -0,0 +1,232 @@
+import copy
+import json
+import logging
+import os
+import queue
+import re
+import threading
+from collections import deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import time
+
+from crawler.queuemanager import read_job_model
+
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_interval(text: str):
+    """
+    Convert an interval such as '30m', '12h', '1d' or '1w' (or plain
+    seconds) into seconds.
+    """
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$', str(text))
+    if m is None:
+        raise ValueError("Invalid interval: {}".format(text))
+    return float(m.group(1)) * INTERVAL_UNITS[m.group(2) or 's']
+
+
+class Scheduler:
+    """
+    Keeps job models in memory (re-read only when their file changes) and
+    decides which jobs are due. Every job file jobs/JOB.ini runs on its own
+    interval; the time of the last run of every job is persisted in
+    state_file so a restarted daemon keeps the schedule.
+    """
+
+    def __init__(self, schedule: dict, default_interval: float = 86400, job_dir: str = 'jobs',
+                 state_file: str = os.path.join('data', 'daemon_state.json')):
+        self.schedule = schedule
+        self.default_interval = default_interval
+        self.job_dir = job_dir
+        self.state_file = state_file
+        self._models = {}  # job -> (mtime, job model)
+        self.last_run = {}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self.last_run = json.load(f)
+
+    def jobs(self):
+        """All job models in job_dir, keyed by job name"""
+        jobs = {}
+        for file_name in os.listdir(self.job_dir):
+            if not file_name.endswith((".ini", ".json")):
+                continue
+            path = os.path.join(self.job_dir, file_name)
+            job = os.path.splitext(file_name)[0]
+            mtime = os.path.getmtime(path)
+            if job not in self._models or self._models[job][0] != mtime:
+                self._models[job] = (mtime, read_job_model(path))
+            jobs[job] = self._models[job][1]
+        return jobs
+
+    def interval(self, job: str):
+        return self.schedule.get(job, self.default_interval)
+
+    def next_run(self, job: str):
+        return self.last_run.get(job, 0) + self.interval(job)
+
+    def due(self, now: float = None):
+        """Names of jobs whose interval has passed"""
+        now = now or time()
+        return [job for job in self.jobs() if self.next_run(job) <= now]
+
+    def mark_run(self, job: str, when: float = None):
+        self.last_run[job] = when or time()
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.last_run, f, indent=2)
+        os.replace(tmp_file, self.state_file)
+
+    def resolve(self, name: str):
+        """
+        Job queue for a job name or a single table name, None if unknown.
+        A deep copy is returned, since the crawler updates job models in place.
+        """
+        jobs = self.jobs()
+        if name in jobs:
+            return copy.deepcopy(jobs[name])
+        for job_model in jobs.values():
+            if name in job_model:
+                return {name: copy.deepcopy(job_model[name])}
+        return None
+
+
+class Daemon:
+    """
+    Long-running crawler: schedules jobs, runs them one batch at a time in
+    a runner thread and serves a small local control/status endpoint:
+
+        GET  /status       scheduled jobs, run in flight, queued runs, history
+        POST /run/NAME     queue a job (file name without extension) or a
+                           single table for an immediate run
+
+    :param execute: generator function taking a job queue and yielding
+                    (table, success) as every table completes
+    """
+
+    def __init__(self, execute, scheduler: Scheduler, host: str = '127.0.0.1', port: int = 8765,
+                 tick: float = 60, logger_name: str = 'crawler'):
+        self.execute = execute
+        self.scheduler = scheduler
+        self.host = host
+        self.port = port
+        self.tick = tick
+        self._logger = logging.getLogger(logger_name)
+        self._runs = queue.Queue()
+        self._lock = threading.Lock()
+        self._queued = []
+        self._running = None
+        self._history = deque(maxlen=50)
+        self._stop = threading.Event()
+        self._server = None
+
+    def trigger(self, name: str, reason: str = 'manual'):
+        """Queue a job or table by name, False if the name is unknown"""
+        job_queue = self.scheduler.resolve(name)
+        if job_queue is None:
+            return False
+        with self._lock:
+            self._queued.append(name)
+        self._runs.put((name, reason, job_queue))
+        self._logger.info("{}: Queued ({})".format(name, reason))
+        return True
+
+    def status(self):
+        with self._lock:
+            jobs = {job: {"interval": self.scheduler.interval(job),
+                          "last_run": _iso(self.scheduler.last_run.get(job)),
+                          "next_run": _iso(self.scheduler.next_run(job)),
+                          "tables": list(model)}
+                    for job, model in self.scheduler.jobs().items()}
+            return {"running": copy.deepcopy(self._running),
+                    "queued": list(self._queued),
+                    "jobs": jobs,
+                    "history": list(self._history)}
+
+    def _runner(self):
+        while not self._stop.is_set():
+            try:
+                name, reason, job_queue = self._runs.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self._queued.remove(name)
+                self._running = {"name": name, "reason": reason, "started": _iso(time()),
+                                 "pending": list(job_queue), "done": {}}
+            try:
+                for table, success in self.execute(job_queue):
+                    with self._lock:
+                        self._running["pending"].remove(table)
+                        self._running["done"][table] = success
+            except Exception as e:
+                self._logger.error("{}: {}".format(name, e))
+            with self._lock:
+                self._running["finished"] = _iso(time())
+                self._history.appendleft(self._running)
+                self._running = None
+
+    def serve_forever(self):
+        self._server = _ControlServer((self.host, self.port), _ControlHandler)
+        self._server.crawler_daemon = self
+        threading.Thread(target=self._server.serve_forever, name='control', daemon=True).start()
+        threading.Thread(target=self._runner, name='runner', daemon=True).start()
+        self._logger.info("Daemon listening on http://{}:{}".format(self.host, self.port))
+
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    busy = set(self._queued) | ({self._running["name"]} if self._running else set())
+                for job in self.scheduler.due():
+                    if job not in busy:
+                        self.scheduler.mark_run(job)
+                        self.trigger(job, 'scheduled')
+                self._stop.wait(self.tick)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _iso(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat() if timestamp else None
+
+
+class _ControlServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ControlHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, code: int, body: dict):
+        payload = json.dumps(body, indent=2, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            self._reply(200, self.server.crawler_daemon.status())
+        else:
+            self._reply(404, {"error": "unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        m = re.match(r'^/run/([\w.\-]+)/?$', self.path)
+        if m is None:
+            self._reply(404, {"error": "unknown path {}".format(self.path)})
+        elif self.server.crawler_daemon.trigger(m.group(1)):
+            self._reply(202, {"queued": m.group(1)})
+        else:
+            self._reply(404, {"error": "unknown job or table {}".format(m.group(1))})
+
+    def log_message(self, format, *args):
+        logging.getLogger('crawler').debug("control: " + format % args)
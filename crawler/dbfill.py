@@ -1,7 +1,15 @@
+import hashlib
+import os
+
 import cx_Oracle
+import numpy as np
+import pandas as pd
 from configparser import ConfigParser
 import logging
 
+from crawler.sqlldr import SqlLoader, format_userid, render_control_file, write_data_file
+from crawler.utils import CellErrorCounter
+
 
 class DB:
     """Pseudo-class for Oracle connections"""
@@ -11,23 +19,25 @@ class DB:
         Basic logging set-up, configuration file parsing, connection test
         """
         # Logging set-up
-        # TODO: Move this to config file
+        # crawler.init_logger() routes this logger through the shared log
+        # queue; handlers are only added here for standalone use and only once
         self._application_name = "DbFill"
         self._logger = logging.getLogger(self._application_name)
-        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            self._logger.setLevel(logging.INFO)
 
-        formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+            formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
 
-        file_handler = logging.FileHandler('logs/dbfill.log')
-        file_handler.setLevel(logging.INFO)
-        file_handler.setFormatter(formatter)
+            file_handler = logging.FileHandler('logs/dbfill.log')
+            file_handler.setLevel(logging.INFO)
+            file_handler.setFormatter(formatter)
 
-        console = logging.StreamHandler()
-        console.setLevel(logging.WARNING)
-        console.setFormatter(formatter)
+            console = logging.StreamHandler()
+            console.setLevel(logging.WARNING)
+            console.setFormatter(formatter)
 
-        self._logger.addHandler(console)
-        self._logger.addHandler(file_handler)
+            self._logger.addHandler(console)
+            self._logger.addHandler(file_handler)
 
         try:
             # Parse configuration from INI
@@ -46,12 +56,23 @@ class DB:
             self._dsn = cx_Oracle.makedsn(self._conn_oracle_sett["host"], self._conn_oracle_sett["port"],
                                           self._conn_oracle_sett["sid"])
 
-            self._oracle_conn = cx_Oracle.connect(self._conn_oracle_sett["user"], self._conn_oracle_sett["password"],
-                                                  self._dsn, encoding="UTF-8", nencoding="UTF-16")
+            self.connect()
 
         except Exception as e:
             self._logger.exception(e)
 
+    def connect(self):
+        self._oracle_conn = cx_Oracle.connect(self._conn_oracle_sett["user"], self._conn_oracle_sett["password"],
+                                              self._dsn, encoding="UTF-8", nencoding="UTF-16")
+
+    def ensure_connected(self):
+        """Reconnect if the connection was lost, for long-running processes"""
+        try:
+            self._oracle_conn.ping()
+        except Exception:
+            self._logger.warning('Oracle connection lost, reconnecting')
+            self.connect()
+
 
 class DbFill(DB):
     """
@@ -70,70 +91,252 @@ class DbFill(DB):
             result.append(tmp_dic)
         return result
         
-    def _kaz_encode(self, data):
+    @staticmethod
+    def _kaz_escape(word):
+        '''
+        Escape a single value for _kaz_encode.
+
+        :return: tuple (value as stored through UNISTR(), escaped value)
+        '''
+        tmp_word = word.replace('\\','//')
+        decoded = tmp_word
+        for s in word:
+            try:
+                s.encode('iso8859-5')
+            except UnicodeEncodeError:
+                tmp_word = tmp_word.replace(s, s.encode('unicode-escape').decode('utf-8'))
+                # Replace \u with \ for oracle and expand \x into \00
+                tmp_word = tmp_word.replace('\\u', '\\')
+                tmp_word = tmp_word.replace('\\x', '\\00')
+        return decoded, tmp_word
+
+    def _kaz_encode(self, data, checksum=None, errors=None):
         '''
         Encode all Kazakh letters that do not get decoded by the ISO8859-5 codec
         into unicode format of the form:
             \XXXX
+
+        If a LoadChecksum is given, it is updated with every encoded row.
+        Cell errors are collected in errors (a CellErrorCounter); if none is
+        given they are logged as a summary when encoding is done.
         '''
 
+        report_errors = errors is None
+        if report_errors:
+            errors = CellErrorCounter()
         result = []
-        bad_symbols = {}
         for entry in data:
             tmp_entry = {}
             for key, word in entry.items():
                 try:
-                    tmp_word = word.replace('\\','//')
-                    tmp_word = tmp_word.replace('nan','')
-                    for s in word:
-                        try:
-                            s.encode('iso8859-5')
-                        except UnicodeEncodeError:
-                            # print('found it: {}'.format(s))
-                            # print('replacing with: {}'.format(s.encode('unicode-escape').decode('utf-8').replace(r'\u0', r'\0')))
-                            # input("Press Enter .................................")
-                            tmp_word = tmp_word.replace(s, s.encode('unicode-escape').decode('utf-8'))
-                            # Replace \u with \ for oracle and expand \x into \00
-                            tmp_word = tmp_word.replace('\\u', '\\')
-                            tmp_word = tmp_word.replace('\\x', '\\00')
-                            
-                            bad_symbols[s] = s.encode('unicode-escape').decode('utf-8').replace(r'\u0', r'\0')
+                    decoded, tmp_word = self._kaz_escape(word)
+                    if checksum is not None:
+                        checksum.add(key, *checksum.summary(key, decoded, tmp_word))
                     tmp_entry[key] = tmp_word
                 except AttributeError as e:
-                    self._logger.exception(e)
+                    errors.add(key, word, e)
             result.append(tmp_entry)
-        
+
+        if report_errors:
+            errors.log(self._logger)
         return result
 
-    def fill_main_storage(self, table_name, structure, data, charset="utf-8", nvar_cols=None):
-        """Fill table"""
+    def _kaz_escape_values(self, key, values, errors, checksum):
+        """
+        _kaz_escape every value of a column.
+
+        :return: tuple of numpy arrays (escaped values, lengths and hashes
+                 of the values as stored, see LoadChecksum.summary)
+        """
+        escaped = np.empty(len(values), dtype=object)
+        lengths = np.zeros(len(values), dtype=np.int64)
+        hashes = np.zeros(len(values), dtype=np.int64)
+        for i, word in enumerate(values):
+            try:
+                decoded, escaped[i] = self._kaz_escape(word)
+                lengths[i], hashes[i] = checksum.summary(key, decoded, escaped[i])
+            except AttributeError as e:
+                errors.add(key, word, e)
+                escaped[i] = ''
+        return escaped, lengths, hashes
+
+    def _kaz_encode_frame(self, frame, structure, checksum, errors, escaped_categories):
+        """
+        Column-wise _kaz_encode of a DataFrame batch.
+
+        Categorical columns are escaped once per distinct value (kept in
+        escaped_categories across batches) and only expanded to one value
+        per row here, right before binding.
+
+        :return: list of row tuples in structure order
+        """
+        columns = []
+        for key in structure:
+            col = frame[key]
+            if str(col.dtype) == 'category':
+                categories = col.cat.categories
+                if key not in escaped_categories or not escaped_categories[key][0].equals(categories):
+                    # last entry serves missing values (code -1)
+                    escaped_categories[key] = (categories, self._kaz_escape_values(
+                        key, list(categories) + [''], errors, checksum))
+                escaped, lengths, hashes = escaped_categories[key][1]
+                codes = col.cat.codes.values
+                escaped, lengths, hashes = escaped[codes], lengths[codes], hashes[codes]
+            else:
+                escaped, lengths, hashes = self._kaz_escape_values(key, col.values, errors, checksum)
+            checksum.add(key, int(lengths.sum()), int(hashes.sum()))
+            columns.append(escaped.tolist())
+
+        return list(zip(*columns))
+
+    @staticmethod
+    def _unistr_columns(structure, nvar_cols=None):
+        """Columns whose values are decoded with UNISTR() on the server"""
+        # Encase unicode string literals with UNISTR() for columns with keyword in column name
+        if nvar_cols:
+            keywords = nvar_cols
+        else:
+            keywords = ["kaz", "kz", "name", "address", "activity", "fio"]
+        return [head for head in structure if any(kw in head.lower() for kw in keywords)]
+
+    def _encoded_batches(self, data, structure, checksum, errors, batch_size):
+        """
+        _kaz_encode data batch by batch.
+
+        :return: generator of lists of rows (dicts for a list of
+                 dictionaries, otherwise tuples in structure order)
+        """
+        if isinstance(data, list):
+            return (self._kaz_encode(data[start:start + batch_size], checksum, errors)
+                    for start in range(0, len(data), batch_size))
+        if isinstance(data, pd.DataFrame):
+            data = [data]
+        # frames larger than batch_size (e.g. whole sheets) are split
+        frames = (frame.iloc[start:start + batch_size]
+                  for frame in data for start in range(0, len(frame), batch_size))
+        escaped_categories = {}
+        return (self._kaz_encode_frame(frame, structure, checksum, errors, escaped_categories)
+                for frame in frames)
+
+    def fill_main_storage(self, table_name, structure, data, charset="utf-8", nvar_cols=None, batch_size=50000):
+        """
+        Fill table in batches of batch_size rows.
+
+        :param data: pandas.DataFrame with structure columns (categorical
+                     columns are bound without expanding the whole column),
+                     an iterable of such DataFrames (batches, e.g.
+                     crawler.handoff.ArrowFrames) or list of dictionaries
+        :return: LoadChecksum with the row count summed from executemany
+                 and the checksum of all inserted values, None on failure
+        """
         try:
-            data = self._kaz_encode(data)
-            
             sql = "insert into {} (".format(table_name)
-            param_vals_lst = []
-            # Encase unicode string literals with UNISTR() for columns with keyword in column name
-            if nvar_cols:
-                keywords = nvar_cols
-            else:
-                keywords = ["kaz", "kz", "name", "address", "activity", "fio"]
-            for i, head in enumerate(structure):
-                if any(kw in head.lower() for kw in keywords):
-                    param_vals_lst.append("UNISTR(:{})".format(head))
-                else:
-                    param_vals_lst.append(":{}".format(head))
+            unistr_cols = self._unistr_columns(structure, nvar_cols)
+            param_vals_lst = ["UNISTR(:{})".format(head) if head in unistr_cols else ":{}".format(head)
+                              for head in structure]
 
             columns_statement = ', '.join(structure)
             values_statement = ', '.join(param_vals_lst)
             sql = sql + columns_statement + ') values (' + values_statement + ')'
-            
+
+            checksum = LoadChecksum(structure, unistr_cols)
+            errors = CellErrorCounter()
             or_cur = self._oracle_conn.cursor()
             or_cur.prepare(sql)
-            or_cur.executemany(None, data)
+            # frame rows are bound by position, in structure order
+            batches = self._encoded_batches(data, structure, checksum, errors, batch_size)
+            for batch in batches:
+                or_cur.executemany(None, batch)
+                checksum.rows += or_cur.rowcount
             self._oracle_conn.commit()
+            errors.log(self._logger, '{}: '.format(table_name))
+            return checksum
         except Exception as e:
             self._logger.exception(e)
-        
+            # batches inserted before the failure would otherwise be
+            # committed by the next DDL (TRUNCATE of the next table)
+            try:
+                self._oracle_conn.rollback()
+            except Exception as rollback_error:
+                self._logger.error('{}: Rollback failed: {}'.format(table_name, rollback_error))
+
+    def bulk_load(self, table_name, structure, data, work_dir, nvar_cols=None, batch_size=50000, loader=None):
+        """
+        Direct-path load through SQL*Loader instead of INSERTs: data is
+        encoded exactly as by fill_main_storage, written to
+        work_dir/TABLE.dat with a generated control file TABLE.ctl and
+        loaded with sqlldr direct=true.
+
+        :param data: As for fill_main_storage
+        :param crawler.sqlldr.SqlLoader loader: Runs sqlldr (default SqlLoader())
+        :return: LoadChecksum with the row count reported by sqlldr and the
+                 checksum of all written values, None on failure
+        """
+        loader = loader or SqlLoader()
+        data_file = os.path.join(work_dir, table_name + '.dat')
+        control_file = os.path.join(work_dir, table_name + '.ctl')
+        try:
+            os.makedirs(work_dir, exist_ok=True)
+            unistr_cols = self._unistr_columns(structure, nvar_cols)
+            checksum = LoadChecksum(structure, unistr_cols)
+            errors = CellErrorCounter()
+            batches = ([tuple(row.get(key, '') for key in structure) for row in batch] if isinstance(data, list) else batch
+                       for batch in self._encoded_batches(data, structure, checksum, errors, batch_size))
+            rows, field_lengths = write_data_file(batches, data_file)
+            errors.log(self._logger, '{}: '.format(table_name))
+            with open(control_file, 'w', encoding='utf-8') as f:
+                f.write(render_control_file(table_name, structure, unistr_cols, data_file, field_lengths))
+            self._logger.info('{}: Loading {} rows with sqlldr'.format(table_name, rows))
+
+            loaded = loader.load(control_file, format_userid(
+                self._conn_oracle_sett["user"], self._conn_oracle_sett["password"], self._dsn))
+            if loaded is None:
+                return None
+            checksum.rows = loaded
+            return checksum
+        except Exception as e:
+            self._logger.exception(e)
+        finally:
+            if not loader.keep_files:
+                for f in (data_file, control_file):
+                    if os.path.exists(f):
+                        os.remove(f)
+
+    def verify_checksum(self, table_name, checksum):
+        """
+        Recompute the per-column character counts and content hashes (see
+        LoadChecksum) of a loaded table on the server with a single
+        aggregate query and compare them with the LoadChecksum (or its dict
+        form) reported by fill_main_storage or bulk_load.
+
+        Needs Oracle 12c or later (STANDARD_HASH).
+
+        :return: True if row count and all column lengths and hashes match
+        """
+        if isinstance(checksum, dict):
+            checksum = LoadChecksum.from_dict(checksum)
+        columns = list(checksum.lengths)
+        hashed = [col for col in columns if col in checksum.hashes]
+        sql = "SELECT COUNT(*){}{} FROM {}".format(
+            ''.join(", SUM(NVL(LENGTH({}), 0))".format(col) for col in columns),
+            ''.join(", " + HASH_SUM_SQL.format(col) for col in hashed), table_name)
+        or_cur = self._oracle_conn.cursor()
+        or_cur.execute(sql)
+        result = or_cur.fetchone()
+
+        matches = int(result[0]) == checksum.rows
+        for col, db_length in zip(columns, result[1:]):
+            if int(db_length) != checksum.lengths[col]:
+                self._logger.error("{}: Column {} holds {} characters, expected {}".format(
+                    table_name, col, int(db_length), checksum.lengths[col]))
+                matches = False
+        for col, db_hash in zip(hashed, result[1 + len(columns):]):
+            if int(db_hash) != checksum.hashes[col]:
+                self._logger.error("{}: Column {} content differs from the loaded values "
+                                   "(hash sum {}, expected {})".format(table_name, col, int(db_hash),
+                                                                       checksum.hashes[col]))
+                matches = False
+        return matches
 
     def send_command(self, command):
         or_cur = self._oracle_conn.cursor()
@@ -153,7 +356,74 @@ class DbFill(DB):
         return result[0]
 
     def purge(self, tables):
+        """
+        Truncate tables. Unlike send_command, errors are raised: a table
+        that could not be cleared (locked, referenced by a foreign key, no
+        privilege) must not be loaded, its new rows would be appended to
+        the old ones.
+
+        :raises cx_Oracle.DatabaseError: if a TRUNCATE fails
+        """
         if type(tables) is not list: tables = [tables]
+        or_cur = self._oracle_conn.cursor()
         for table in tables:
-            sql = 'TRUNCATE TABLE {}'.format(table)
-            self.send_command(sql)
+            or_cur.execute('TRUNCATE TABLE {}'.format(table))
+
+
+# Server side of value_hash, summed over a column (NULL, i.e. '', counts 0)
+HASH_SUM_SQL = ("SUM(NVL(TO_NUMBER(SUBSTR(RAWTOHEX(STANDARD_HASH("
+                "UTL_I18N.STRING_TO_RAW({}, 'AL32UTF8'), 'MD5')), 1, 8), 'XXXXXXXX'), 0))")
+
+
+def value_hash(value):
+    """First 32 bits of the MD5 of a stored value's UTF-8 bytes, 0 for ''"""
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:8], 16) if value else 0
+
+
+class LoadChecksum:
+    """
+    Order-independent summary of the values loaded by fill_main_storage or
+    bulk_load, per column of the values as stored in the database (UNISTR()
+    columns hold the decoded values, all others the escaped ones):
+
+        rows     number of rows reported by the load
+        lengths  total number of characters
+        hashes   sum of value_hash of every value
+
+    Both can be recomputed by the server with a single aggregate query (see
+    DbFill.verify_checksum). The lengths catch truncated or dropped values,
+    the hashes also catch same-length garbling such as a Kazakh letter
+    stored as '?'.
+    """
+
+    def __init__(self, structure, unistr_cols=()):
+        self.rows = 0
+        self.lengths = dict.fromkeys(structure, 0)
+        self.hashes = dict.fromkeys(structure, 0)
+        self._unistr_cols = set(unistr_cols)
+
+    def summary(self, key, decoded, escaped):
+        """
+        Tuple (length, value_hash) of a value of column key as stored:
+        decoded (before escaping) for UNISTR() columns, escaped (as bound)
+        for all others
+        """
+        stored = decoded if key in self._unistr_cols else escaped
+        return len(stored), value_hash(stored)
+
+    def add(self, key, length, hash_sum):
+        self.lengths[key] += length
+        self.hashes[key] += hash_sum
+
+    def to_dict(self):
+        return {"rows": self.rows, "lengths": self.lengths, "hashes": self.hashes,
+                "unistr_cols": sorted(self._unistr_cols)}
+
+    @classmethod
+    def from_dict(cls, d):
+        checksum = cls(d["lengths"].keys(), d.get("unistr_cols", ()))
+        checksum.rows = d["rows"]
+        checksum.lengths = dict(d["lengths"])
+        # journals written before content hashes only hold lengths
+        checksum.hashes = dict(d.get("hashes", {}))
+        return checksum
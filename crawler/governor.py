@@ -0,0 +1,157 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from contextlib import contextmanager
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def read_rss(pid='self'):
+    """Resident set size of a process (this one by default) in bytes, from /proc/PID/statm"""
+    with open('/proc/{}/statm'.format(pid), 'r') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def read_total_rss():
+    """
+    Resident set size of this process and its multiprocessing children
+    (e.g. the workers of a crawler.handoff.ParsePool) in bytes
+    """
+    total = read_rss()
+    for child in multiprocessing.active_children():
+        try:
+            total += read_rss(child.pid)
+        except (OSError, ValueError, IndexError):
+            # exited since listed
+            pass
+    return total
+
+
+def input_size(table_data: dict):
+    """Bytes of the spreadsheets a table is built from"""
+    return sum(os.path.getsize(p) for p in set(table_data.get("path", [])) if os.path.exists(p))
+
+
+class MemoryGovernor:
+    """
+    Keeps the crawler under an RSS budget.
+
+    The memory a table needs is estimated from the size of its spreadsheets:
+    scaled from the peak measured on earlier runs of the table (kept in
+    history_file) or, for unknown tables, input size times expansion.
+    A table is admitted for in-memory parsing only if its estimate fits the
+    headroom left under the budget; otherwise it is parsed and loaded sheet
+    by sheet. Above pressure (fraction of the budget) loads switch to small
+    batches. Headroom and pressure count the memory of parse workers too,
+    the peaks in the history only that of this process.
+
+        governor = MemoryGovernor(8 * 2 ** 30)
+        with governor.track(table_name, table_data):
+            if governor.admit(table_name, table_data):
+                ...   # whole table in memory
+            else:
+                ...   # streaming
+
+    :param int budget: RSS budget in bytes
+    :param rss_func: Function returning the current RSS in bytes
+                     (read_total_rss by default), replaceable to simulate
+                     memory pressure
+    """
+
+    def __init__(self, budget: int, history_file: str = os.path.join('data', 'memory_history.json'),
+                 expansion: float = 10.0, pressure: float = 0.8, small_batch: int = 5000,
+                 rss_func=None, logger_name: str = 'crawler'):
+        self.budget = budget
+        self.history_file = history_file
+        self.expansion = expansion
+        self.pressure = pressure
+        self.small_batch = small_batch
+        self.rss = rss_func or read_total_rss
+        # peaks of a table parsed here must not include concurrent parse workers
+        self._own_rss = rss_func or read_rss
+        self._logger = logging.getLogger(logger_name)
+        self.history = {}
+        self._admitted = set()
+        if os.path.exists(history_file):
+            with open(history_file, 'r') as f:
+                self.history = json.load(f)
+
+    def headroom(self):
+        return self.budget - self.rss()
+
+    def under_pressure(self):
+        return self.rss() > self.pressure * self.budget
+
+    def estimate(self, table_name: str, table_data: dict):
+        """Estimated peak memory of parsing and loading table in one piece, in bytes"""
+        size = input_size(table_data)
+        seen = self.history.get(table_name)
+        if seen and seen["input_bytes"] > 0:
+            return int(seen["peak"] * size / seen["input_bytes"])
+        return int(size * self.expansion)
+
+    def admit(self, table_name: str, table_data: dict):
+        """True if table may be held in memory as a whole, False to stream it"""
+        estimate = self.estimate(table_name, table_data)
+        headroom = self.headroom()
+        if estimate <= headroom:
+            self._admitted.add(table_name)
+            return True
+        self._logger.info('{}: Needs ~{} MB with {} MB headroom, streaming'.format(
+            table_name, estimate // 2 ** 20, max(headroom, 0) // 2 ** 20))
+        return False
+
+    def admit_all(self, job_queue: dict, workers: int):
+        """
+        Tables that can be parsed concurrently by workers: every admitted
+        table fits a worker's share of the headroom.
+        """
+        share = self.headroom() / max(workers, 1)
+        return {table_name: table_data for table_name, table_data in job_queue.items()
+                if self.estimate(table_name, table_data) <= share}
+
+    def batch_size(self, default: int):
+        """Rows per load batch: small_batch under pressure, default otherwise"""
+        if self.under_pressure():
+            self._logger.debug('Memory pressure, loading in batches of {} rows'.format(self.small_batch))
+            return min(default, self.small_batch)
+        return default
+
+    @contextmanager
+    def track(self, table_name: str, table_data: dict, interval: float = 0.5):
+        """
+        Sample RSS while the block runs and record the table's peak in the
+        history, if it was admitted (a streamed table's peak says nothing
+        about holding it in memory).
+        """
+        start = self._own_rss()
+        peak = [start]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(interval):
+                peak[0] = max(peak[0], self._own_rss())
+
+        sampler = threading.Thread(target=sample, name='rss-sampler', daemon=True)
+        sampler.start()
+        try:
+            yield
+        finally:
+            done.set()
+            sampler.join()
+            peak[0] = max(peak[0], self._own_rss())
+            if table_name in self._admitted:
+                self._admitted.discard(table_name)
+                self.record(table_name, input_size(table_data), peak[0] - start)
+
+    def record(self, table_name: str, input_bytes: int, peak: int):
+        if input_bytes <= 0 or peak <= 0:
+            return
+        self.history[table_name] = {"input_bytes": input_bytes, "peak": peak}
+        os.makedirs(os.path.dirname(self.history_file) or '.', exist_ok=True)
+        tmp_file = self.history_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.history, f, indent=2)
+        os.replace(tmp_file, self.history_file)
@@ -0,0 +1,226 @@
+import logging
+import logging.handlers
+import multiprocessing
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+from crawler.probe import probe_table
+from crawler.queuemanager import prepare_data, WorkbookCache
+
+PARSED_FILE = '.parsed.arrow'
+
+# loggers of the crawler code running in parse workers
+WORKER_LOGGERS = ('crawler', 'DbFill')
+
+# set in every parse worker by _init_worker: queue of (group, pid) of started parses
+_started = None
+
+
+class WorkerLost(Exception):
+    """Raised when the worker parsing a table died (e.g. killed out of memory)"""
+    pass
+
+
+def arrow_available():
+    return pa is not None
+
+
+def write_arrow(data, path: str, batch_size: int = 50000):
+    """
+    Write a parsed DataFrame as an Arrow IPC file of record batches.
+    Categorical columns are kept dictionary-encoded.
+    """
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    tmp_path = path + '.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        writer = pa.ipc.new_file(sink, table.schema)
+        writer.write_table(table, max_chunksize=batch_size)
+        writer.close()
+    os.replace(tmp_path, path)
+    return path
+
+
+class ArrowFrames:
+    """
+    Memory-mapped Arrow IPC file of a parsed table. Opening it maps the file
+    without copying; iterating yields one DataFrame per record batch, so
+    only a single batch is ever converted to Python objects (for binding).
+    Can be passed to DbFill.fill_main_storage instead of a DataFrame.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._source = pa.memory_map(path, 'r')
+        self._reader = pa.ipc.open_file(self._source)
+        self.columns = self._reader.schema.names
+
+    def __len__(self):
+        return sum(self._reader.get_batch(i).num_rows for i in range(self._reader.num_record_batches))
+
+    def __iter__(self):
+        for i in range(self._reader.num_record_batches):
+            yield self._reader.get_batch(i).to_pandas()
+
+    def to_pandas(self):
+        return self._reader.read_all().to_pandas()
+
+    def close(self):
+        self._source.close()
+
+
+def _init_worker(log_queue, started_queue=None):
+    """
+    Worker process initializer: send every log record to the parent through
+    log_queue and report the parses started through started_queue
+    """
+    global _started
+    _started = started_queue
+    handler = logging.handlers.QueueHandler(log_queue)
+    for name in WORKER_LOGGERS:
+        lg = logging.getLogger(name)
+        for h in list(lg.handlers):
+            lg.removeHandler(h)
+        lg.addHandler(handler)
+        lg.setLevel(logging.DEBUG)
+        lg.propagate = False
+
+
+class _ForwardHandler(logging.Handler):
+    """Hands records received from workers to the parent's logger of the same name"""
+
+    def emit(self, record):
+        lg = logging.getLogger(record.name)
+        if lg.isEnabledFor(record.levelno):
+            lg.handle(record)
+
+
+def _parse_group(group: dict, update_fingerprints: bool = False, group_no: int = None):
+    """
+    Worker process: probe and parse every table of a group (tables sharing
+    workbooks, opened once) and write each to an Arrow file in its store.
+
+    :return: dict of table -> path of Arrow file, or the exception raised
+    """
+    if _started is not None:
+        _started.put((group_no, os.getpid()))
+    workbooks = WorkbookCache(group)
+    results = {}
+    for table_name, table_data in group.items():
+        try:
+            probe_table(table_data, table_name, update=update_fingerprints, workbooks=workbooks)
+            data = prepare_data(table_data, table_name, workbooks=workbooks)
+            os.makedirs(table_data["store"], exist_ok=True)
+            results[table_name] = write_arrow(data, os.path.join(table_data["store"], PARSED_FILE))
+        except Exception as e:
+            results[table_name] = e
+        finally:
+            workbooks.release(table_data)
+    workbooks.close()
+    return results
+
+
+def _group_by_workbook(job_queue: dict):
+    """Split the job queue into groups of tables that share no files with other groups"""
+    groups = []
+    for table_name, table_data in job_queue.items():
+        paths = set(table_data.get("path", []))
+        shared = [g for g in groups if g[0] & paths]
+        merged = (paths, {table_name: table_data})
+        for g in shared:
+            groups.remove(g)
+            merged[0].update(g[0])
+            merged[1].update(g[1])
+        groups.append(merged)
+    return [tables for _, tables in groups]
+
+
+class ParsePool:
+    """
+    Parses tables in worker processes. Results come back as paths of Arrow
+    files written under each table's store rather than pickled DataFrames,
+    so handing a multi-million row table to the loader costs a file map
+    instead of a serialisation round trip.
+
+    Workers are spawned rather than forked (the parent runs logging and
+    heartbeat threads whose locks a fork would copy); their log records are
+    sent back through a multiprocessing queue and logged by the parent's
+    loggers of the same name.
+
+    A worker that dies while parsing (e.g. killed by the OOM killer) never
+    returns its result; result() notices that the process is gone and raises
+    WorkerLost instead of waiting forever.
+
+        with ParsePool(job_queue, workers=4) as pool:
+            for table_name, table_data in job_queue.items():
+                data = pool.result(table_name)   # ArrowFrames
+    """
+
+    def __init__(self, job_queue: dict, workers: int, update_fingerprints: bool = False, poll: float = 5):
+        context = multiprocessing.get_context('spawn')
+        self.poll = poll
+        self._log_queue = context.Queue()
+        self._log_listener = logging.handlers.QueueListener(self._log_queue, _ForwardHandler())
+        self._log_listener.start()
+        # written synchronously: the report must not die with the worker in a feeder thread
+        self._started = context.SimpleQueue()
+        self._pids = {}  # group number -> pid of the worker parsing it
+        self._pool = context.Pool(workers, initializer=_init_worker, initargs=(self._log_queue, self._started))
+        self._results = {}
+        for group_no, group in enumerate(_group_by_workbook(job_queue)):
+            result = self._pool.apply_async(_parse_group, (group, update_fingerprints, group_no))
+            for table_name in group:
+                self._results[table_name] = (group_no, result)
+
+    def __contains__(self, table_name: str):
+        return table_name in self._results
+
+    def _worker_alive(self, group_no: int):
+        """False once the worker that started parsing group has exited"""
+        while not self._started.empty():
+            started_no, pid = self._started.get()
+            self._pids[started_no] = pid
+        pid = self._pids.get(group_no)
+        # not started yet, or still running
+        return pid is None or pid in (p.pid for p in multiprocessing.active_children())
+
+    def result(self, table_name: str):
+        """
+        Wait for table to be parsed.
+
+        :return: ArrowFrames of the parsed table
+        :raises WorkerLost: if the worker died before finishing the table
+        :raises: whatever the parse raised in the worker
+        """
+        group_no, pending = self._results[table_name]
+        while True:
+            try:
+                result = pending.get(self.poll)[table_name]
+                break
+            except multiprocessing.TimeoutError:
+                # the pool replaces a dead worker but its task is lost
+                if not pending.ready() and not self._worker_alive(group_no):
+                    raise WorkerLost('{}: Parse worker died'.format(table_name))
+        if isinstance(result, Exception):
+            raise result
+        return ArrowFrames(result)
+
+    def close(self):
+        """Wait for parses still running, then stop the workers and their log forwarding"""
+        self._pool.close()
+        if any(not pending.ready() and not self._worker_alive(group_no)
+               for group_no, pending in self._results.values()):
+            # join() would wait for the lost results
+            self._pool.terminate()
+        self._pool.join()
+        self._log_listener.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+STAGES = ('downloaded', 'extracted', 'parsed', 'loaded', 'verified')
+
+
+class RunJournal:
+    """
+    Persistent record of which stages every table has completed in the
+    current run, together with the artefacts each stage produced, e.g.:
+
+        {"started": "2018-06-01T13:00:00",
+         "tables": {"CR_STATGOV_OKED": {
+             "downloaded": {"at": "...", "files": ["data/CR_STATGOV_OKED/oked.xlsx"]},
+             "extracted": {"at": "...", "path": [...], "sheet": [...], "skip_row": [...]},
+             "parsed": {"at": "...", "file": "data/CR_STATGOV_OKED/.parsed.pkl", "rows": 1000}}}}
+
+    The journal is rewritten atomically after every stage, so a crash leaves
+    the last completed stage of every table on disk for a --resume run.
+    """
+
+    def __init__(self, journal_file: str = os.path.join('data', 'run_journal.json'), resume: bool = False):
+        self.journal_file = journal_file
+        self._lock = threading.Lock()
+        self._state = {"started": datetime.now().isoformat(), "tables": {}}
+
+        if resume and os.path.exists(journal_file):
+            with open(journal_file, 'r') as f:
+                self._state = json.load(f)
+        else:
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.journal_file) or '.', exist_ok=True)
+        tmp_file = self.journal_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self._state, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, self.journal_file)
+
+    def mark(self, table: str, stage: str, **artefacts):
+        """
+        Record that table completed stage. Any later stages recorded before
+        are dropped, since they were derived from the previous artefacts.
+        """
+        if stage not in STAGES:
+            raise ValueError("Unknown stage: {}".format(stage))
+        with self._lock:
+            stages = self._state["tables"].setdefault(table, {})
+            for later in STAGES[STAGES.index(stage) + 1:]:
+                stages.pop(later, None)
+            artefacts["at"] = datetime.now().isoformat()
+            stages[stage] = artefacts
+            self._save()
+
+    def done(self, table: str, stage: str):
+        """True if table completed stage"""
+        with self._lock:
+            return stage in self._state["tables"].get(table, {})
+
+    def artefacts(self, table: str, stage: str):
+        """Artefacts recorded for a completed stage (empty dict if none)"""
+        with self._lock:
+            return dict(self._state["tables"].get(table, {}).get(stage, {}))
+
+    def reset(self, table: str, stage: str = None):
+        """Forget everything recorded for table, or only stage and the later ones"""
+        with self._lock:
+            if stage is None:
+                self._state["tables"].pop(table, None)
+            else:
+                stages = self._state["tables"].get(table, {})
+                for later in STAGES[STAGES.index(stage):]:
+                    stages.pop(later, None)
+            self._save()
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import re
+
+import pandas as pd
+
+# index_col patterns, from most to least specific
+INDEX_PATTERNS = [r'^\d+$', r'^[\w.\-/]+$', r'\S']
+
+
+class SchemaMismatch(Exception):
+    """Raised when a spreadsheet no longer matches its job model"""
+    pass
+
+
+def _normalise(value):
+    return re.sub(r'\s+', ' ', str(value)).strip().lower()
+
+
+def _index_pattern(values: list):
+    """Most specific of INDEX_PATTERNS matched by all values"""
+    for pattern in INDEX_PATTERNS:
+        if all(re.search(pattern, v) for v in values):
+            return pattern
+    return None
+
+
+def sample_sheet(xls: pd.ExcelFile, sheet, skip_row: int, structure: list, index_col: str, n_rows: int = 5):
+    """
+    Read only the header and the first n_rows data rows of a sheet and
+    describe its layout.
+
+    :return: dict with keys
+             n_cols        number of columns in the sampled rows
+             header        hash of the last non-blank row above the data
+                           (the column headings)
+             index_values  sampled values of index_col
+             empty         True if the sampled data rows are all blank
+    """
+    df = xls.parse(sheet_name=sheet, index_col=None, header=None, dtype=str, nrows=skip_row + n_rows)
+    df = df.fillna('')
+    header_rows = [[_normalise(v) for v in row] for row in df.iloc[:skip_row].values.tolist()]
+    header_rows = [row for row in header_rows if any(row)]
+    header = '\x1f'.join(header_rows[-1]).rstrip('\x1f') if header_rows else ''
+
+    data = df.iloc[skip_row:]
+    idx = structure.index(index_col)
+    index_values = [str(v).strip() for v in data.iloc[:, idx]] if data.shape[1] > idx else []
+    return {"n_cols": data.shape[1],
+            "header": hashlib.sha1(header.encode('utf-8')).hexdigest(),
+            "index_values": index_values,
+            "empty": bool(data.isin(['', 'nan']).values.all())}
+
+
+def probe_table(table_data: dict, table_name: str, fingerprint_dir: str = os.path.join('jobs', 'fingerprints'),
+                update: bool = False, workbooks=None, logger_name: str = 'crawler'):
+    """
+    Fail-fast check of a table's spreadsheets against its job model before
+    the full parse. For every sheet only the first rows after skip_row are
+    read and checked for:
+
+      - column count (exactly len(structure) for a selected sheet, at least
+        that many when all sheets are read, since extra columns are trimmed)
+      - header fingerprint, compared with the one stored for the table
+      - index_col values, which must be non-blank and match the stored pattern
+
+    When all sheets of a workbook are read, sheets without data (e.g. an
+    empty extra sheet) are skipped instead of checked.
+
+    The first probe of a table stores its fingerprint in
+    fingerprint_dir/TABLE.json. Later probes only compare, unless update is
+    set, in which case the observed layout replaces the stored one.
+
+    :raises SchemaMismatch: if any sheet does not match
+    """
+    logger = logging.getLogger(logger_name)
+    structure = table_data["structure"]
+    fingerprint_file = os.path.join(fingerprint_dir, table_name + '.json')
+    stored = None
+    if os.path.exists(fingerprint_file) and not update:
+        with open(fingerprint_file, 'r') as f:
+            stored = json.load(f)
+
+    headers, index_values = [], []
+    for i, file in enumerate(table_data["path"]):
+        xls = workbooks.get(file) if workbooks is not None else pd.ExcelFile(file)
+        try:
+            sheets = xls.sheet_names if table_data["sheet"][i] is None else [table_data["sheet"][i]]
+            for sheet in sheets:
+                sample = sample_sheet(xls, sheet, table_data["skip_row"][i], structure, table_data["index_col"])
+                where = '{} [{}]'.format(os.path.basename(file), sheet)
+                if table_data["sheet"][i] is None and sample["empty"]:
+                    logger.debug('{}: {} has no data, skipped'.format(table_name, where))
+                    continue
+
+                n_cols = sample["n_cols"]
+                if n_cols < len(structure) or (table_data["sheet"][i] is not None and n_cols != len(structure)):
+                    raise SchemaMismatch('{}: {} has {} columns, expected {}'.format(
+                        table_name, where, n_cols, len(structure)))
+                if not sample["index_values"] or sample["index_values"][0] in ('', 'nan'):
+                    raise SchemaMismatch('{}: {} has no data in {} right after row {}'.format(
+                        table_name, where, table_data["index_col"], table_data["skip_row"][i]))
+                if stored is not None and sample["header"] not in stored["headers"]:
+                    raise SchemaMismatch('{}: {} column headings changed'.format(table_name, where))
+
+                headers.append(sample["header"])
+                # sampled rows may already run into the trailing blank rows
+                index_values.extend(v for v in sample["index_values"] if v not in ('', 'nan'))
+        finally:
+            if workbooks is None:
+                xls.close()
+
+    if stored is not None:
+        pattern = stored.get("index_pattern")
+        if pattern and not all(re.search(pattern, v) for v in index_values):
+            raise SchemaMismatch('{}: {} values do not match {}'.format(
+                table_name, table_data["index_col"], pattern))
+        logger.debug('{}: Layout matches stored fingerprint'.format(table_name))
+    else:
+        os.makedirs(fingerprint_dir, exist_ok=True)
+        with open(fingerprint_file, 'w') as f:
+            json.dump({"n_cols": len(structure),
+                       "headers": sorted(set(headers)),
+                       "index_pattern": _index_pattern(index_values)}, f, indent=2)
+        logger.info('{}: Stored layout fingerprint in {}'.format(table_name, fingerprint_file))
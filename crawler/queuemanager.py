@@ -6,6 +6,7 @@ import os
 from configparser import ConfigParser
 from contextlib import redirect_stdout
 
+import numpy as np
 import pandas as pd
 import re
 import zipfile
@@ -71,17 +72,22 @@ def queue_jobs(job_dir: str = 'jobs'):
     return _job_queue
 
 
-def retrieve_file_object(url: str):
+def retrieve_file_object(url: str, session: requests.Session = None, headers: dict = None):
     """
     Retrieves attached file names from URL and returns a GET request result
 
     :param str url: URL source of presumed downloadable content
+    :param requests.Session session: Reuse the connection pool of a session
+    :param dict headers: Extra request headers, e.g. for a conditional GET
     :return:    tuple (result, filename)
         WHERE
         requests.models.Response result
         str filename is the name of the attachment with extension
+                     (None if the server answered 304 Not Modified)
     """
-    result = requests.get(url, verify=False, stream=True)
+    result = (session or requests).get(url, verify=False, stream=True, headers=headers)
+    if result.status_code == 304:
+        return result, None
     try:
         cont_disp = parse.unquote(result.headers["content-disposition"])
         if re.search("UTF-8''(.*);", cont_disp) is not None:
@@ -97,37 +103,115 @@ def retrieve_file_object(url: str):
     return result, file_name
 
 
-def download_extract_files(job_queue: dict, logger_name: str = 'crawler'):
+def download_extract_files(job_queue: dict, logger_name: str = 'crawler', journal=None,
+                           session: requests.Session = None, artefacts=None):
     """
     Download files and extract any xls file in archives. Return file paths list. Delete RAR/ZIPs.
+
+    :param dict job_queue: Dictionary of table names with job models
+    :param str logger_name: Name of logger
+    :param crawler.journal.RunJournal journal: If given, completed stages are
+                            recorded and tables whose stages were already
+                            completed (with artefacts still on disk) are skipped
+    :param requests.Session session: Download through a (warm) session
+    :param crawler.artefacts.ArtefactStore artefacts: If given, downloads and
+                            extracted spreadsheets are moved into this content-
+                            addressed store (archives are kept there instead of
+                            deleted), unchanged urls are not downloaded again
+                            and every table's files are recorded as a snapshot
     """
 
     logger = logging.getLogger(logger_name)
 
+    # Identical urls (and archives) are fetched and extracted only once per run
+    downloaded_by_url = {}
+    extracted_by_file = {}
+    # file path -> (url, file name, response headers) for the artefact store
+    origin = {}
+
     for table, table_info in job_queue.items():
         # 1. Iterate through tables
+        # every table gets its store, also when all of its files are shared or cached
+        os.makedirs(table_info["store"], exist_ok=True)
+        if journal is not None and journal.done(table, 'extracted'):
+            extracted = journal.artefacts(table, 'extracted')
+            if all(os.path.exists(p) for p in extracted["path"]):
+                logger.info('{}: Already extracted, resuming'.format(table))
+                for k in ("path", "sheet", "skip_row", "last_row"):
+                    job_queue[table][k] = extracted.get(k, [None] * len(extracted["path"]))
+                continue
+
+        if journal is not None and journal.done(table, 'downloaded') and \
+                all(os.path.exists(p) for p in journal.artefacts(table, 'downloaded')["files"]):
+            logger.info('{}: Already downloaded, resuming'.format(table))
+            downloaded = journal.artefacts(table, 'downloaded')["files"]
+        else:
+            downloaded = []
+            for url in table_info["urls"]:
+                # 2. Iterate through urls for each table and download
+                if url in downloaded_by_url:
+                    logger.debug('{}: Already downloaded {}'.format(table, url))
+                    downloaded.append(downloaded_by_url[url])
+                    continue
+                cached = artefacts.lookup_url(url) if artefacts is not None else None
+                headers = {}
+                if cached is not None and cached["etag"]:
+                    headers['If-None-Match'] = cached["etag"]
+                if cached is not None and cached["last_modified"]:
+                    headers['If-Modified-Since'] = cached["last_modified"]
+                result, file_name = retrieve_file_object(url, session, headers)
+                if result.status_code == 304:
+                    logger.debug('{}: {} not modified, using stored copy'.format(table, cached["name"]))
+                    for blob in [cached["blob"]] + cached["spreadsheets"]:
+                        artefacts.touch(blob)
+                    downloaded.append(cached["blob"])
+                    downloaded_by_url[url] = cached["blob"]
+                    extracted_by_file[cached["blob"]] = cached["spreadsheets"]
+                    continue
+                file_path = os.path.join(table_info["store"], file_name)
+                # file_name = file_name.encode('utf-8').decode('utf-8')
+                logger.debug('{}: Downloading {}'.format(table, file_name))
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, 'wb') as f:
+                    # written as it arrives, a large download is never held in memory
+                    for chunk in result.iter_content(chunk_size=2 ** 20):
+                        f.write(chunk)
+                if artefacts is not None:
+                    file_path = artefacts.put(file_path)
+                    origin[file_path] = (url, file_name, result.headers)
+                downloaded.append(file_path)
+                downloaded_by_url[url] = file_path
+            if journal is not None:
+                journal.mark(table, 'downloaded', files=downloaded)
+
         job_queue[table]["path"] = []  # reset paths
         temp_sheet = []  # temporary sheet number selector
         temp_skip_row = []  # temporary skip row selector
-        for i, url in enumerate(table_info["urls"]):
-            # 2. Iterate through urls for each table and download
-            result, file_name = retrieve_file_object(url)
-            file_path = os.path.join(table_info["store"], file_name)
-            # file_name = file_name.encode('utf-8').decode('utf-8')
-            logger.debug('{}: Downloading {}'.format(table, file_name))
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, 'wb') as f:
-                f.write(result.content)
-
+        temp_last_row = []  # temporary last row selector
+        last_rows = table_info.get("last_row") or [None] * len(table_info["urls"])
+        for i, file_path in enumerate(downloaded):
+            file_name = origin[file_path][1] if file_path in origin else os.path.basename(file_path)
             _, file_ext = os.path.splitext(file_path)
 
             # 3. (Extract and) Append path to spreadsheet
-            if file_ext in (".xls", ".xlsx"):
+            if file_path in extracted_by_file:
+                # archive shared with a previous table, already extracted and removed
+                for f in extracted_by_file[file_path]:
+                    job_queue[table]["path"].append(f)
+                    temp_sheet.append(job_queue[table]["sheet"][i])
+                    temp_skip_row.append(job_queue[table]["skip_row"][i])
+                    temp_last_row.append(last_rows[i])
+
+            elif file_ext in (".xls", ".xlsx"):
 
                 logger.debug('{}: Saving {}'.format(table, file_name))
                 job_queue[table]["path"].append(file_path)
                 temp_sheet.append(job_queue[table]["sheet"][i])
                 temp_skip_row.append(job_queue[table]["skip_row"][i])
+                temp_last_row.append(last_rows[i])
+                if file_path in origin:
+                    artefacts.record_url(origin[file_path][0], file_name, file_path, [file_path],
+                                         origin[file_path][2])
 
             elif file_ext in (".rar", ".zip"):
                 if file_ext == ".rar":
@@ -137,34 +221,284 @@ def download_extract_files(job_queue: dict, logger_name: str = 'crawler'):
                     logger.debug("{}: Checking contents of {}".format(table, file_name))
                     archive = zipfile.ZipFile(file_path)
 
+                extracted_by_file[file_path] = []
                 for idx, f in enumerate(archive.namelist()):
                     # check for excel and extract
                     _, f_ext = os.path.splitext(f)
                     if f_ext in (".xls", ".xlsx"):
                         archive.extract(f, table_info["store"])
                         logger.debug("{}: Saving {} (from {})".format(table, f, file_name))
-                        job_queue[table]["path"].append(os.path.join(table_info["store"], f))
+                        f_path = os.path.join(table_info["store"], f)
+                        if artefacts is not None:
+                            f_path = artefacts.put(f_path)
+                        extracted_by_file[file_path].append(f_path)
+                        job_queue[table]["path"].append(f_path)
                         temp_sheet.append(job_queue[table]["sheet"][i])
                         temp_skip_row.append(job_queue[table]["skip_row"][i])
+                        temp_last_row.append(last_rows[i])
 
-                logger.debug("{}: Removing {}".format(table, file_name))
-                try:
+                if artefacts is not None:
+                    # the archive stays in the store
                     archive.close()
-                    os.remove(file_path)
-                except Exception as e:
-                    logger.warning("{}: Could not delete {}\n"
-                                   "{}".format(table, file_name, e))
+                    if file_path in origin:
+                        artefacts.record_url(origin[file_path][0], file_name, file_path,
+                                             extracted_by_file[file_path], origin[file_path][2])
+                else:
+                    logger.debug("{}: Removing {}".format(table, file_name))
+                    try:
+                        archive.close()
+                        os.remove(file_path)
+                    except Exception as e:
+                        logger.warning("{}: Could not delete {}\n"
+                                       "{}".format(table, file_name, e))
 
             else:
                 logger.error("{}: Did not recognize downloaded file extension: {}".format(table, file_name))
 
         job_queue[table]["sheet"] = temp_sheet
         job_queue[table]["skip_row"] = temp_skip_row
+        job_queue[table]["last_row"] = temp_last_row
+        if artefacts is not None:
+            artefacts.record(table, [{"blob": p, "sheet": sh, "skip_row": sk, "last_row": lr}
+                                     for p, sh, sk, lr in zip(job_queue[table]["path"], temp_sheet,
+                                                              temp_skip_row, temp_last_row)])
+        if journal is not None:
+            journal.mark(table, 'extracted', path=job_queue[table]["path"],
+                         sheet=temp_sheet, skip_row=temp_skip_row, last_row=temp_last_row)
 
     return job_queue
 
 
-def prepare_data(table_data: dict, table_name: str, logger_name: str = 'crawler'):
+class WorkbookCache:
+    """
+    Keeps workbooks open across tables, so that a spreadsheet needed by
+    several tables (e.g. different sheets of the same file) is opened and
+    parsed only once per run. A workbook is closed after the last table
+    using it has been released.
+    """
+
+    def __init__(self, job_queue: dict):
+        self._users = {}
+        self._open = {}
+        for table_data in job_queue.values():
+            for path in set(table_data.get("path", [])):
+                self._users[path] = self._users.get(path, 0) + 1
+
+    def get(self, path: str):
+        """Return the open pandas.ExcelFile for path"""
+        if path not in self._open:
+            self._open[path] = pd.ExcelFile(path)
+        return self._open[path]
+
+    def release(self, table_data: dict):
+        """Mark table as done with its workbooks, close unused ones"""
+        for path in set(table_data.get("path", [])):
+            self._users[path] = self._users.get(path, 1) - 1
+            if self._users[path] <= 0 and path in self._open:
+                self._open.pop(path).close()
+
+    def close(self):
+        for xls in self._open.values():
+            xls.close()
+        self._open = {}
+
+
+def _is_blank(values: pd.Series):
+    """Cells counted as blank by prepare_data (empty, NaN or stringified NaN/None)"""
+    return values.isnull() | values.astype(str).str.strip().isin(['', 'nan', 'None'])
+
+
+def _scan_index_column(xls: pd.ExcelFile, sheet, skip_row: int, n_rows: int, index_pos: int):
+    """
+    Number of data rows before the first blank cell of the index column,
+    read straight from the xlrd book without building any DataFrame.
+
+    :return: row count, or None if there is no blank cell (or it is the
+             first row) or the engine's book cannot be scanned cheaply
+    """
+    book = getattr(xls, 'book', None)
+    if not hasattr(book, 'sheet_by_index'):
+        # e.g. openpyxl: scanning costs as much as parsing the rows
+        return None
+    xl_sheet = book.sheet_by_name(sheet) if isinstance(sheet, str) else book.sheet_by_index(sheet)
+    if index_pos >= xl_sheet.ncols:
+        return None
+    end_row = skip_row + n_rows if n_rows is not None else None
+    for i, value in enumerate(xl_sheet.col_values(index_pos, start_rowx=skip_row, end_rowx=end_row)):
+        if str(value).strip() in ('', 'nan', 'None'):
+            return i if i > 0 else None
+    return None
+
+
+def read_workbook(file: str, sheets: list, skip_row: int, n_cols: int = None, workbooks: WorkbookCache = None,
+                  last_row: int = None, index_pos: int = None):
+    """
+    Parse a workbook once and yield every requested sheet from that single
+    parse. Cells are yielded as strings, missing cells as ''.
+
+    Only the row window of every sheet is turned into a DataFrame: rows
+    after last_row are never read, and with index_pos the data ends right
+    before the first blank cell of that column. With xlrd the index column
+    is scanned on its own first, so trailing footnotes and formatted blank
+    rows are not parsed at all; other engines trim right after parsing.
+
+    :param str file: Path to spreadsheet
+    :param list sheets: Sheet names or zero-based indices to read. A value
+                        of [None] means all sheets of the workbook
+    :param int skip_row: Number of rows to skip before reading data
+    :param int n_cols: Keep only the first n_cols columns of every sheet
+    :param WorkbookCache workbooks: Take the workbook from (and leave it
+                                    open in) a cache shared across tables
+    :param int last_row: Last (1-based) spreadsheet row to read, None for all
+    :param int index_pos: Zero-based position of the index column; stop at
+                          its first blank cell (unless that is the first row)
+    :return: generator of tuples (sheet, pandas.DataFrame)
+    """
+    xls = workbooks.get(file) if workbooks is not None else pd.ExcelFile(file)
+    try:
+        if sheets == [None]:
+            # PANDAS BUG (pandas = 0.23.0):
+            #    For some reason pandas fails to read all sheets if sheet_name=None
+            sheets = xls.sheet_names
+
+        for sheet in sheets:
+            n_rows = last_row - skip_row if last_row is not None else None
+            if index_pos is not None:
+                data_rows = _scan_index_column(xls, sheet, skip_row, n_rows, index_pos)
+                if data_rows is not None:
+                    n_rows = data_rows
+            # dtype=object keeps blank cells as NaN, dtype=str would turn them into 'nan'
+            df = xls.parse(sheet_name=sheet,
+                           index_col=None,
+                           skiprows=skip_row,
+                           nrows=n_rows,
+                           dtype=object,
+                           header=None)
+            if index_pos is not None and df.shape[1] > index_pos:
+                # Without a scan (or with readers dropping blank lines) the
+                # window can only end late, trim to the first blank
+                blank = np.flatnonzero(_is_blank(df.iloc[:, index_pos]).values)
+                if len(blank) > 0 and blank[0] > 0:
+                    df = df.iloc[:blank[0]]
+            if n_cols is not None:
+                # Remove unnecessary columns just in case
+                df = df.iloc[:, 0:n_cols]
+            # cells as strings, missing cells blank
+            missing = df.isnull()
+            df = df.astype(str).mask(missing, '')
+            yield sheet, df
+    finally:
+        if workbooks is None:
+            xls.close()
+
+
+def map_categories(series: pd.Series, func):
+    """
+    Apply func once per distinct value of a categorical series instead of
+    once per row. Values func maps together are merged, missing values
+    become func('').
+    """
+    mapped = pd.Index([func(c) for c in series.cat.categories], dtype=object)
+    uniques = mapped.unique()
+    if len(uniques) == 0 or func('') not in uniques:
+        uniques = uniques.append(pd.Index([func('')], dtype=object))
+    # old code -> new code, the appended last entry serves missing values (code -1)
+    recode = np.append(uniques.get_indexer(mapped), uniques.get_loc(func('')))
+    codes = recode[series.cat.codes.values]
+    return pd.Series(pd.Categorical.from_codes(codes, uniques), index=series.index, name=series.name)
+
+
+# Column cleaning steps for the job model key "clean"
+CLEANERS = {
+    'strip': lambda s: s.str.strip(),                                # leading/trailing whitespace
+    'collapse': lambda s: s.str.replace(r'\s+', ' ', regex=True),   # runs of whitespace to one space
+    'upper': lambda s: s.str.upper(),
+}
+
+# Cleaning of columns not named in "clean"
+DEFAULT_CLEAN = ['strip']
+
+
+def clean_column(series: pd.Series, steps: list):
+    """
+    Apply the CLEANERS steps to a column of strings, vectorised over the
+    column (over its categories for a categorical column).
+    """
+    unknown = [step for step in steps if step not in CLEANERS]
+    if unknown:
+        raise ValueError("Unknown cleaning step(s): {}".format(', '.join(unknown)))
+    if not steps:
+        return series
+    categorical = str(series.dtype) == 'category'
+    values = pd.Series(series.cat.categories, dtype=object) if categorical else series
+    for step in steps:
+        values = CLEANERS[step](values)
+    if categorical:
+        cleaned = dict(zip(series.cat.categories, values))
+        return map_categories(series, lambda v: cleaned.get(v, v))
+    return values
+
+
+def _concat_frames(frames: list, categorical: list):
+    """Concatenate once, keeping categorical columns encoded"""
+    for col in categorical:
+        # identical categories in every frame, otherwise concat falls back to object
+        categories = pd.Index([], dtype=object).append([f[col].cat.categories for f in frames]).unique()
+        for f in frames:
+            f[col] = f[col].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _read_sheets(table_data: dict, workbooks: WorkbookCache = None):
+    """Every sheet of a table as read by read_workbook, categorical columns encoded"""
+    structure = table_data["structure"]
+    categorical_pos = [structure.index(col) for col in table_data.get("categorical", [])]
+    last_rows = table_data.get("last_row") or [None] * len(table_data["path"])
+    index_pos = structure.index(table_data["index_col"]) if table_data.get("stop_at_blank", True) else None
+    # Open Excel
+    for i, file in enumerate(table_data["path"]):
+        if table_data["sheet"][i] is None:
+            # Iterate through all sheets if no specific sheet selected
+            sheets, n_cols = [None], len(structure)
+        else:
+            # Get only from selected sheet
+            sheets, n_cols = [table_data["sheet"][i]], None
+
+        for _, df in read_workbook(file, sheets, table_data["skip_row"][i], n_cols, workbooks,
+                                   last_rows[i], index_pos):
+            if df.shape[0] == 0:
+                # e.g. an empty extra sheet of a workbook read as a whole
+                continue
+            if df.shape[1] < len(structure):
+                df = df.reindex(columns=range(len(structure)), fill_value='')
+            for pos in categorical_pos:
+                df[pos] = df[pos].astype('category')
+            yield df
+
+
+def _clean_frame(data: pd.DataFrame, table_data: dict):
+    """Clean every column in place with the steps set in the job model key 'clean'"""
+    clean = table_data.get("clean", {})
+    for col in table_data["structure"]:
+        data[col] = clean_column(data[col], clean.get(col, clean.get("*", DEFAULT_CLEAN)))
+
+
+def iter_prepared_data(table_data: dict, table_name: str, logger_name: str = 'crawler',
+                       workbooks: WorkbookCache = None):
+    """
+    Streaming prepare_data: yield the table sheet by sheet, each sheet
+    cleaned as prepare_data would, so that only one sheet is held in memory.
+    Can be passed to DbFill.fill_main_storage instead of a DataFrame.
+    """
+    logger = logging.getLogger(logger_name)
+    logger.debug("{}: Pre-processing sheet by sheet...".format(table_name))
+    for df in _read_sheets(table_data, workbooks):
+        df.columns = table_data["structure"]
+        _clean_frame(df, table_data)
+        yield df
+
+
+def prepare_data(table_data: dict, table_name: str, logger_name: str = 'crawler', workbooks: WorkbookCache = None):
     """
     Iterate through all files and load into single dataframe
 
@@ -172,61 +506,38 @@ def prepare_data(table_data: dict, table_name: str, logger_name: str = 'crawler'
           then the options sheet and skip_row are valid for ALL those
           spreadsheets
 
+    Reading stops at last_row of every source and, unless the optional job
+    model key "stop_at_blank" is False, at the first blank index_col cell
+    of every sheet (see read_workbook).
+
+    Columns listed in the optional job model key "categorical" are
+    dictionary-encoded (pandas category dtype) right after each sheet is
+    read, so that highly repetitive values are stored and cleaned once.
+
+    Missing cells are blank. Every column is then cleaned with the steps
+    (see CLEANERS) the optional job model key "clean" maps it to, e.g.
+    {"*": ["strip"], "Full_Name_Ru": ["strip", "collapse"]}; "*" sets the
+    steps of unnamed columns, DEFAULT_CLEAN by default.
+
 
     :param dict table_data: Dictionary containing single table's
                             structure, source paths
     :param str table_name: Name of table
     :param str logger_name: Name of logger
+    :param WorkbookCache workbooks: Cache of workbooks shared across tables
     """
     logger = logging.getLogger(logger_name)
 
     logger.debug("{}: Pre-processing...".format(table_name))
-    # Blank data frame
-    data = pd.DataFrame()
-    # Open Excel
-    for i, file in enumerate(table_data["path"]):
-        xls = pd.ExcelFile(file)
-        xls_sheets = xls.sheet_names
+    structure = table_data["structure"]
+    categorical_pos = [structure.index(col) for col in table_data.get("categorical", [])]
+    frames = list(_read_sheets(table_data, workbooks))
 
-        if table_data["sheet"][i] is None:
-            # Iterate through all sheets if no specific sheet selected
-            # PANDAS BUG (pandas = 0.23.0):
-            #    For some reason pandas fails to read all sheets if sheet_name=None
-            for sheet in xls_sheets:
-                df = pd.read_excel(file,
-                                   sheet_name=sheet,
-                                   index_col=None,
-                                   skiprows=table_data["skip_row"][i],
-                                   dtype=str,
-                                   header=None)
-
-                data = data.append(df, ignore_index=True)
-                # Remove unnecessary columns just in case
-                data = data.iloc[:, 0:len(table_data["structure"])]
+    # Single concatenation instead of appending sheet by sheet
+    data = _concat_frames(frames, categorical_pos) if frames else pd.DataFrame()
 
-        else:
-            # Get only from selected sheet
-            df = pd.read_excel(file,
-                               sheet_name=table_data['sheet'][i],
-                               index_col=None,
-                               skiprows=table_data["skip_row"][i],
-                               dtype=str,
-                               header=None)
-
-            data = data.append(df, ignore_index=True)
-
-    data.columns = table_data["structure"]
-    # Remove NaN rows and everything below
-    data = data.replace(['nan', 'None'], '', regex=True)  # replaces 'nan' strings with blanks
-    rows_b_trunc = len(data)
-    try:
-        # locate first instance of blank cell in index_col and truncate data up to that cell
-        data = data.loc[:data[(data[table_data["index_col"]] == '')].index[0] - 1, :]
-        if len(data) == 0:
-            raise IndexError
-        logger.debug('{}: Trimmed from {} to {} rows'.format(table_name, rows_b_trunc, len(data)))
-    except IndexError:
-        pass
+    data.columns = structure
+    _clean_frame(data, table_data)
     logger.debug('{}: Pre-processing complete, {} rows'.format(table_name, len(data)))
     return data
 
@@ -0,0 +1,142 @@
+import logging
+import os
+import re
+import subprocess
+
+# Records end with RS + newline so values may span lines, fields are always
+# enclosed in double quotes (doubled inside values) and separated by commas
+RECORD_TERMINATOR = '\x1e\n'
+FIELD_TERMINATOR = ','
+ENCLOSURE = '"'
+
+# SQL*Loader reads CHAR fields of up to 255 bytes unless told otherwise
+MIN_FIELD_LENGTH = 255
+
+
+def format_record(values):
+    """One data file record of a row of strings"""
+    return FIELD_TERMINATOR.join(
+        ENCLOSURE + value.replace('\x1e', '').replace(ENCLOSURE, ENCLOSURE * 2) + ENCLOSURE
+        for value in values) + RECORD_TERMINATOR
+
+
+def write_data_file(batches, path: str):
+    """
+    Write rows (batches of tuples of strings, in column order) to a UTF-8
+    data file for SQL*Loader. RS characters are dropped from values, they
+    would end the record.
+
+    :return: tuple (number of rows, list of the longest value per column in bytes)
+    """
+    rows = 0
+    max_len = None
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for batch in batches:
+            for row in batch:
+                if max_len is None:
+                    max_len = [0] * len(row)
+                for i, value in enumerate(row):
+                    max_len[i] = max(max_len[i], len(value.encode('utf-8')))
+                f.write(format_record(row))
+                rows += 1
+    return rows, max_len or []
+
+
+def render_control_file(table_name: str, structure: list, unistr_cols: list, data_file: str,
+                        field_lengths: list = None):
+    """
+    SQL*Loader control file appending data_file to table_name. Columns in
+    unistr_cols hold \\XXXX escaped text (see DbFill._kaz_escape) and are
+    decoded with UNISTR() on the server, as in the INSERT load path.
+
+    :param list field_lengths: Longest value per column in bytes, as
+                               returned by write_data_file
+    """
+    field_lengths = field_lengths or [0] * len(structure)
+    fields = []
+    for col, length in zip(structure, field_lengths):
+        field = '  {} CHAR({})'.format(col, max(length, MIN_FIELD_LENGTH))
+        if col in unistr_cols:
+            field += ' "UNISTR(:{})"'.format(col)
+        fields.append(field)
+    return ("LOAD DATA\n"
+            "CHARACTERSET AL32UTF8\n"
+            "INFILE '{data_file}' \"str X'1E0A'\"\n"
+            "APPEND\n"
+            "INTO TABLE {table}\n"
+            "FIELDS TERMINATED BY '{sep}' ENCLOSED BY '{quote}'\n"
+            "TRAILING NULLCOLS\n"
+            "(\n"
+            "{fields}\n"
+            ")\n").format(data_file=data_file, table=table_name, sep=FIELD_TERMINATOR, quote=ENCLOSURE,
+                          fields=',\n'.join(fields))
+
+
+def format_userid(user: str, password: str, connect: str):
+    """
+    userid parameter of a parameter file. The password and the connect
+    string (a makedsn descriptor full of parentheses, '=' and spaces) are
+    quoted, the whole value is quoted again for the parameter file parser.
+    """
+    return '"{}/\\"{}\\"@\\"{}\\""'.format(user, password, connect)
+
+
+def run_process(args: list):
+    """Default SqlLoader runner: run args, return (exit code, output)"""
+    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return result.returncode, result.stdout.decode('utf-8', 'replace')
+
+
+class SqlLoader:
+    """
+    Direct-path load of a data file through sqlldr.
+
+    The credentials go into a parameter file readable only by the owner
+    (removed after the load), never onto the command line. The sqlldr log
+    and bad files are removed after a successful load unless keep_files is
+    set; after a failed one they are kept for diagnosis.
+
+    :param str executable: sqlldr binary
+    :param runner: Function taking the argument list and returning (exit
+                   code, output); replace it to load without sqlldr
+    """
+
+    def __init__(self, executable: str = 'sqlldr', runner=None, keep_files: bool = False,
+                 logger_name: str = 'DbFill'):
+        self.executable = executable
+        self.runner = runner or run_process
+        self.keep_files = keep_files
+        self._logger = logging.getLogger(logger_name)
+
+    def load(self, control_file: str, userid: str):
+        """
+        Run sqlldr direct=true on control_file.
+
+        :param str userid: user/password@connect-string, as quoted by format_userid
+        :return: number of rows loaded (from the sqlldr log), None on failure
+        """
+        base, _ = os.path.splitext(control_file)
+        log_file, bad_file, par_file = base + '.log', base + '.bad', base + '.par'
+        fd = os.open(par_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write('userid={}\n'.format(userid))
+        try:
+            code, output = self.runner([self.executable, 'parfile=' + par_file, 'control=' + control_file,
+                                        'log=' + log_file, 'bad=' + bad_file, 'direct=true', 'errors=0'])
+        finally:
+            os.remove(par_file)
+
+        loaded = None
+        if os.path.exists(log_file):
+            with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
+                m = re.search(r'(\d+) Rows? successfully loaded', f.read())
+            if m is not None:
+                loaded = int(m.group(1))
+        if code != 0:
+            self._logger.error('sqlldr exited with code {} (see {})\n{}'.format(code, log_file, output.strip()))
+            return None
+        if not self.keep_files:
+            for f in (log_file, bad_file):
+                if os.path.exists(f):
+                    os.remove(f)
+        return loaded
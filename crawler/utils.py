@@ -1,6 +1,9 @@
 import ast
 import logging
+import logging.handlers
 import os
+import queue
+import threading
 from configparser import RawConfigParser, ConfigParser
 
 import requests
@@ -41,6 +44,33 @@ def get_bot_user_token(conf_file='slack.ini'):
     return parser['slack']['SLACK_BOT_USER_TOKEN'], parser['slack']['channel']
 
 
+def get_settings(section: str, conf_file: str = os.path.join('conf', 'crawler.conf'), **defaults):
+    """
+    Read a section of the crawler configuration. Missing file, section or
+    options fall back to the given defaults (converted to the type of the
+    default value).
+
+    :param str section: Section name, e.g. 'verify'
+    :param str conf_file: Path to crawler configuration file
+    :return: dict of settings
+    :rtype: dict
+    """
+    parser = ConfigParser()
+    parser.read(conf_file)
+
+    settings = dict(defaults)
+    if parser.has_section(section):
+        for k, val in parser.items(section):
+            default = defaults.get(k)
+            if isinstance(default, bool):
+                settings[k] = parser.getboolean(section, k)
+            elif isinstance(default, (int, float)):
+                settings[k] = type(default)(val)
+            else:
+                settings[k] = val
+    return settings
+
+
 def filter_log_count(log_cnt, severity=('ERROR', 'WARNING')):
     new_log_count = {}
     for key, value in log_cnt.items():
@@ -70,6 +100,11 @@ class MsgCounterHandler(logging.Handler):
             self.level2count[lvl] = 0
         self.level2count[lvl] += 1
 
+    def since(self, snapshot: dict):
+        """Counts of messages logged after snapshot (a copy of level2count)"""
+        return {lvl: count - snapshot.get(lvl, 0) for lvl, count in self.level2count.items()
+                if count > snapshot.get(lvl, 0)}
+
 
 class DummySlackClient(object):
     def __init__(self):
@@ -77,3 +112,80 @@ class DummySlackClient(object):
 
     def api_call(self, *args, **kwargs):
         pass
+
+
+def start_queue_logging(handlers: list, counter: logging.Handler, loggers: dict):
+    """
+    Route loggers through a single queue so that slow handlers (files,
+    console) never block the caller. The handlers are attached once to a
+    QueueListener running in its own thread; every logger gets the same
+    QueueHandler plus the (synchronous, cheap) counter handler.
+
+    :param list handlers: Handlers doing the actual output
+    :param logging.Handler counter: Handler kept on the loggers themselves,
+                                    e.g. a MsgCounterHandler
+    :param dict loggers: Logger names with their levels
+    :return: started QueueListener, stop() it to flush at exit
+    :rtype: logging.handlers.QueueListener
+    """
+    log_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+
+    for name, level in loggers.items():
+        lg = logging.getLogger(name)
+        for h in list(lg.handlers):
+            lg.removeHandler(h)
+        lg.addHandler(queue_handler)
+        lg.addHandler(counter)
+        lg.setLevel(level)
+        lg.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def post_async(client, *args, **kwargs):
+    """
+    Call client.api_call(*args, **kwargs) in a background thread. The thread
+    is not a daemon, so the message is still delivered at interpreter exit.
+    """
+    logger = logging.getLogger('crawler')
+
+    def _post():
+        try:
+            client.api_call(*args, **kwargs)
+        except Exception as e:
+            logger.warning('Slack post failed: {}'.format(e))
+
+    thread = threading.Thread(target=_post, name='slack-post')
+    thread.start()
+    return thread
+
+
+class CellErrorCounter(object):
+    """
+    Aggregates errors raised for individual cells into counters per
+    (column, exception type), keeping only a few sampled values, so that a
+    malformed column produces one log line instead of one traceback per cell.
+    """
+
+    def __init__(self, samples: int = 3):
+        self.samples = samples
+        self.counts = {}
+        self.examples = {}
+
+    def add(self, column, value, error: Exception):
+        key = (column, type(error).__name__)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        examples = self.examples.setdefault(key, [])
+        if len(examples) < self.samples:
+            examples.append("{!r} ({})".format(value, error))
+
+    def log(self, logger: logging.Logger, prefix: str = ''):
+        for (column, error), count in self.counts.items():
+            logger.error("{}{}: {} value(s) failed with {}, e.g. {}".format(
+                prefix, column, count, error, '; '.join(self.examples[(column, error)])))
+
+    def __len__(self):
+        return sum(self.counts.values())
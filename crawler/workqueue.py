@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import socket
+import threading
+from time import time
+
+
+class ClaimQueue:
+    """
+    Directory-based work queue shared by several crawler processes or hosts.
+
+    Every table is a single work item stored as a json file. A worker claims
+    an item by atomically renaming it from pending/ to claimed/, and keeps the
+    claim alive by touching the file (heartbeat). Claims whose file has not
+    been touched for longer than the lease are considered abandoned (crashed
+    worker) and are moved back to pending/ by whichever worker notices first.
+
+        queue_dir/
+            pending/TABLE.json
+            claimed/TABLE@worker_id.json
+            done/TABLE.json
+            failed/TABLE.json
+
+    NOTE: os.rename is atomic only within one file system, so all four
+          directories have to live on the same (possibly shared) storage.
+    """
+
+    def __init__(self, queue_dir: str = os.path.join('jobs', 'queue'), lease: float = 300,
+                 worker_id: str = None, logger_name: str = 'crawler'):
+        self.queue_dir = queue_dir
+        self.lease = lease
+        self.worker_id = worker_id or "{}-{}".format(socket.gethostname(), os.getpid())
+        self._logger = logging.getLogger(logger_name)
+
+        for state in ('pending', 'claimed', 'done', 'failed'):
+            os.makedirs(self._dir(state), exist_ok=True)
+
+    def _dir(self, state: str):
+        return os.path.join(self.queue_dir, state)
+
+    def _claim_path(self, table: str):
+        return os.path.join(self._dir('claimed'), "{}@{}.json".format(table, self.worker_id))
+
+    def publish(self, job_queue: dict):
+        """
+        Put every table of the job queue into pending/. Results of previous
+        runs (done/, failed/) are cleared, tables that are currently claimed
+        are left alone.
+        """
+        claimed = {f.split('@')[0] for f in os.listdir(self._dir('claimed'))}
+        for state in ('done', 'failed'):
+            for f in os.listdir(self._dir(state)):
+                os.remove(os.path.join(self._dir(state), f))
+
+        for table, table_data in job_queue.items():
+            if table in claimed:
+                self._logger.warning('{}: Still claimed, not published'.format(table))
+                continue
+            tmp_path = os.path.join(self.queue_dir, '.{}.{}.tmp'.format(table, self.worker_id))
+            with open(tmp_path, 'w') as f:
+                json.dump({table: table_data}, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, os.path.join(self._dir('pending'), table + '.json'))
+
+    def reclaim_expired(self):
+        """Move claims with expired leases back to pending/"""
+        now = time()
+        for f in os.listdir(self._dir('claimed')):
+            path = os.path.join(self._dir('claimed'), f)
+            try:
+                if now - os.path.getmtime(path) <= self.lease:
+                    continue
+                table, owner = os.path.splitext(f)[0].split('@', 1)
+                os.rename(path, os.path.join(self._dir('pending'), table + '.json'))
+                self._logger.warning('{}: Lease of {} expired, re-queued'.format(table, owner))
+            except FileNotFoundError:
+                # someone else completed or re-queued it first
+                pass
+
+    def claim(self):
+        """
+        Claim the next pending table.
+
+        :return: tuple (table, table_data) or None if nothing is pending
+        """
+        self.reclaim_expired()
+        for f in sorted(os.listdir(self._dir('pending'))):
+            table = os.path.splitext(f)[0]
+            pending_path = os.path.join(self._dir('pending'), f)
+            claim_path = self._claim_path(table)
+            try:
+                # the lease starts before the claim is visible, a claim that
+                # kept the pending file's old mtime looks expired to others
+                os.utime(pending_path)
+                os.rename(pending_path, claim_path)
+                with open(claim_path, 'r') as cf:
+                    return table, json.load(cf)[table]
+            except FileNotFoundError:
+                # lost the race to another worker
+                continue
+        return None
+
+    def heartbeat(self, table: str):
+        """Renew the lease on a claimed table. Returns False if the claim was lost."""
+        try:
+            os.utime(self._claim_path(table))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, table: str, success: bool = True):
+        """Move a claimed table to done/ or failed/"""
+        state = 'done' if success else 'failed'
+        try:
+            os.rename(self._claim_path(table), os.path.join(self._dir(state), table + '.json'))
+        except FileNotFoundError:
+            self._logger.warning('{}: Claim was lost before completion '
+                                 '(lease expired?)'.format(table))
+
+    def has_claims(self):
+        """True while any worker still holds a claim"""
+        return len(os.listdir(self._dir('claimed'))) > 0
+
+    def keep_alive(self, table: str):
+        """
+        Context manager renewing the lease of a claimed table in a background
+        thread while the table is being processed. Its lost attribute (an
+        Event) is set once the claim is gone, i.e. another worker may
+        already be processing the table.
+        """
+        return _Heartbeat(self, table)
+
+
+class _Heartbeat:
+    def __init__(self, queue: ClaimQueue, table: str):
+        self._queue = queue
+        self._table = table
+        self._stop = threading.Event()
+        self.lost = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self):
+        while not self._stop.wait(self._queue.lease / 3):
+            if not self._queue.heartbeat(self._table):
+                self._queue._logger.error('{}: Claim lost (lease expired?)'.format(self._table))
+                self.lost.set()
+                return
+
+    def owned(self):
+        """True while the claim is held, renewing the lease"""
+        if not self.lost.is_set() and not self._queue.heartbeat(self._table):
+            self.lost.set()
+        return not self.lost.is_set()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
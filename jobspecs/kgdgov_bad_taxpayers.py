@@ -51,6 +51,10 @@ def create(store=None):
 
     index_cols = ['Num'] * 8
 
+    # columns repeating a few long values, dictionary-encoded while loading
+    categoricals = [[]] * 6
+    categoricals.extend([["region", "office_of_tax_enforcement", "OTE_ID", "economic_sector"]] * 2)
+
     # 2. Define urls
     root_url = "http://kgd.gov.kz/mobile_api/services/taxpayers_unreliable_exportexcel"
     sub_urls = ["/PSEUDO_COMPANY/KZ_ALL/fileName/list_PSEUDO_COMPANY_KZ_ALL.xlsx",
@@ -83,6 +87,7 @@ def create(store=None):
     for i, name in enumerate(table_names):
         job_model[table_names[i]] = {"structure": structures[i],
                                             "index_col": index_cols[i],
+                                            "categorical": categoricals[i],
                                             "urls": urls[i],
                                             "sheet": sheets[i],
                                             "skip_row": skip_rows[i],
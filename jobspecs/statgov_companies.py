@@ -43,6 +43,17 @@ def create(store=None):
 
     index_cols = ["Full_Name_Ru"]
 
+    # columns repeating a few long values, dictionary-encoded while loading
+    categoricals = [["OKED_1", "Activity_Kz", "Activity_Ru", "OKED_2", "KRP", "KRP_Name_Kz", "KRP_Name_Ru",
+                     "KATO", "Settlement_Kz", "Settlement_Ru"]]
+
+    # free-text columns come with doubled and non-breaking spaces
+    cleans = [{"*": ["strip"],
+               "Full_Name_Kz": ["strip", "collapse"],
+               "Full_Name_Ru": ["strip", "collapse"],
+               "Legal_address": ["strip", "collapse"],
+               "Head_FIO": ["strip", "collapse"]}]
+
     # 2. Define urls
     root_url = "http://stat.gov.kz"
 
@@ -71,6 +82,8 @@ def create(store=None):
     for i, name in enumerate(table_names):
         job_model[table_names[i]] = {"structure": structures[i],
                                                   "index_col": index_cols[i],
+                                                  "categorical": categoricals[i],
+                                                  "clean": cleans[i],
                                                   "urls": urls[i],
                                                   "sheet": sheets[i],
                                                   "skip_row": skip_rows[i],
@@ -1,4 +1,39 @@
-from crawler.crawler import run
+import argparse
+import os
+
+from crawler.crawler import run, run_worker, publish, run_daemon
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='telecom_crawler ETL')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the previous run, redoing only unfinished stages')
+    parser.add_argument('--update-fingerprints', action='store_true',
+                        help='accept the current spreadsheet layouts as the new reference')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--daemon', action='store_true',
+                      help='stay running and schedule jobs internally (see conf/crawler.conf)')
+    mode.add_argument('--publish', action='store_true',
+                      help='publish queued jobs as work items for --worker processes')
+    mode.add_argument('--worker', action='store_true',
+                      help='claim and process tables from a shared queue directory')
+    parser.add_argument('--queue-dir', default=os.path.join('jobs', 'queue'),
+                        help='shared queue directory (default: jobs/queue)')
+    parser.add_argument('--lease', type=float, default=300,
+                        help='seconds before a claim without heartbeat is re-queued')
+    args = parser.parse_args()
+
+    # only a one-shot run keeps a journal and takes new layouts
+    mode = next((m for m in ('daemon', 'publish', 'worker') if getattr(args, m)), None)
+    if mode is not None:
+        for option, value in (('--resume', args.resume), ('--update-fingerprints', args.update_fingerprints)):
+            if value:
+                parser.error('{} is not supported with --{}'.format(option, mode))
+
+    if args.daemon:
+        run_daemon()
+    elif args.publish:
+        publish(args.queue_dir)
+    elif args.worker:
+        run_worker(args.queue_dir, lease=args.lease)
+    else:
+        run(resume=args.resume, update_fingerprints=args.update_fingerprints)
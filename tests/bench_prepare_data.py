@@ -0,0 +1,104 @@
+"""
+Benchmark of prepare_data on a many-sheet KATO/companies-style workbook.
+
+Compares the old path (re-opening the workbook for every sheet and
+appending sheet by sheet) against crawler.queuemanager.prepare_data, and
+the old whole-frame regex replace of 'nan' against the cleaning stage.
+
+    $ python tests/bench_prepare_data.py [n_sheets] [rows_per_sheet]
+"""
+import os
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crawler.queuemanager import prepare_data, clean_column, DEFAULT_CLEAN  # noqa: E402
+
+STRUCTURE = ["te", "ab", "cd", "ef", "hij", "k", "name_kaz", "name_rus", "nn"]
+
+
+def make_workbook(path: str, n_sheets: int, rows: int, skip_row: int = 1):
+    """Write a workbook of n_sheets KATO-like sheets with a header row"""
+    with pd.ExcelWriter(path) as writer:
+        for s in range(n_sheets):
+            body = [[str(100000000 + s * rows + r), '11', '22', '33', '444', '5',
+                     'Қазақстан ауылы {}'.format(r), 'Село Казахстан {}'.format(r), '1']
+                    for r in range(rows)]
+            header = [['header'] * len(STRUCTURE)] * skip_row
+            pd.DataFrame(header + body).to_excel(writer, sheet_name='Sheet{}'.format(s),
+                                                  header=False, index=False)
+
+
+def legacy_prepare(table_data: dict):
+    """Pre-change behaviour: N workbook parses and an append per sheet"""
+    data = pd.DataFrame()
+    for i, file in enumerate(table_data["path"]):
+        for sheet in pd.ExcelFile(file).sheet_names:
+            df = pd.read_excel(file, sheet_name=sheet, index_col=None,
+                               skiprows=table_data["skip_row"][i], dtype=str, header=None)
+            data = pd.concat([data, df], ignore_index=True)
+            data = data.iloc[:, 0:len(table_data["structure"])]
+    data.columns = table_data["structure"]
+    return data
+
+
+def legacy_clean(data: pd.DataFrame):
+    """Pre-change cleaning: stringified NaN and a regex over every cell"""
+    return data.astype(str).replace(['nan', 'None'], '', regex=True)
+
+
+def bench_cleaning(rows: int):
+    """Old regex replace against NA masks and clean_column on a companies-like frame"""
+    names = np.array(['ТОО  Financial Group {}', 'Fernando  Nantes {}', 'ИП Ким  {}', '  ТОО Алмаз {} '],
+                     dtype=object)
+    raw = pd.DataFrame({"BIN": [str(100000000000 + r) for r in range(rows)],
+                        "Full_Name_Ru": [names[r % 4].format(r) for r in range(rows)],
+                        "Head_FIO": [None if r % 7 == 0 else 'Нурланов Нурлан' for r in range(rows)]},
+                       dtype=object)
+
+    t0 = time()
+    old = legacy_clean(raw)
+    t_old = time() - t0
+
+    t0 = time()
+    missing = raw.isnull()
+    new = raw.astype(str).mask(missing, '')
+    for col in new.columns:
+        new[col] = clean_column(new[col], ['strip', 'collapse'] if col == 'Full_Name_Ru' else DEFAULT_CLEAN)
+    t_new = time() - t0
+
+    corrupted = int((old["Full_Name_Ru"] != raw["Full_Name_Ru"]).sum())
+    print("cleaning {} rows".format(rows))
+    print("regex replace: {:8.2f}s  ({} names altered, e.g. {!r})".format(
+        t_old, corrupted, old["Full_Name_Ru"][1]))
+    print("clean_column:  {:8.2f}s  (e.g. {!r})".format(t_new, new["Full_Name_Ru"][1]))
+
+
+def main(n_sheets: int = 30, rows: int = 2000):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'kato.xlsx')
+        make_workbook(path, n_sheets, rows)
+        table_data = {"structure": STRUCTURE, "index_col": "te", "path": [path],
+                      "sheet": [None], "skip_row": [1], "last_row": [None]}
+
+        t0 = time()
+        old = legacy_prepare(table_data)
+        t_old = time() - t0
+
+        t0 = time()
+        new = prepare_data(table_data, 'CR_STATGOV_KATO')
+        t_new = time() - t0
+
+    print("{} sheets x {} rows".format(n_sheets, rows))
+    print("legacy:       {:8.2f}s  ({} rows)".format(t_old, len(old)))
+    print("prepare_data: {:8.2f}s  ({} rows)".format(t_new, len(new)))
+    bench_cleaning(n_sheets * rows)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
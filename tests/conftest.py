@@ -0,0 +1,60 @@
+import logging
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+# run from anywhere: import the crawler package from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeDb:
+    """DbFill stand-in recording what process_table loads instead of talking to Oracle"""
+
+    def __init__(self):
+        self.purged = False
+        self.purge_error = None
+        self.data = None
+        self.rows = []
+        self.batch_size = None
+        self.loads = 0
+        self.verified = True
+
+    def purge(self, table_name):
+        if self.purge_error is not None:
+            raise self.purge_error
+        self.purged = True
+
+    def fill_main_storage(self, table_name, structure, data, encoding, batch_size=50000):
+        from crawler.dbfill import LoadChecksum
+        self.data, self.batch_size = data, batch_size
+        self.loads += 1
+        try:
+            for frame in [data] if isinstance(data, pd.DataFrame) else data:
+                self.rows.extend(frame["BIN"])
+        except Exception:
+            self.rows = []  # rolled back
+            return None
+        checksum = LoadChecksum(structure)
+        checksum.rows = len(self.rows)
+        return checksum
+
+    def verify_checksum(self, table_name, checksum):
+        return self.verified
+
+
+@pytest.fixture
+def fake_db():
+    return FakeDb()
+
+
+@pytest.fixture
+def crawler(monkeypatch, tmpdir):
+    """crawler.crawler (needs cx_Oracle and slackclient) run in tmpdir"""
+    pytest.importorskip('cx_Oracle')
+    pytest.importorskip('slackclient')
+    import crawler.crawler as cc
+    monkeypatch.setattr(cc, 'logger', logging.getLogger('crawler'), raising=False)
+    monkeypatch.chdir(str(tmpdir))
+    return cc
@@ -0,0 +1,132 @@
+import multiprocessing
+import os
+from time import time
+
+import pytest
+
+from crawler.artefacts import ArtefactStore, parse_size
+
+
+def make_file(path: str, content: bytes):
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def age(blob: str, seconds: float):
+    os.utime(blob, (time() - seconds, time() - seconds))
+
+
+def test_parse_size():
+    assert parse_size('500M') == 500 * 2 ** 20
+    assert parse_size('1.5g') == int(1.5 * 2 ** 30)
+    assert parse_size('1024') == 1024
+    with pytest.raises(ValueError):
+        parse_size('10 apples')
+
+
+def test_put_keeps_identical_content_once(tmpdir):
+    store = ArtefactStore(str(tmpdir.join('store')))
+    a = store.put(make_file(str(tmpdir.join('a.xlsx')), b'same'))
+    b = store.put(make_file(str(tmpdir.join('b.XLSX')), b'same'))
+
+    assert a == b
+    assert list(store._blobs()) == [a]
+    assert not os.path.exists(str(tmpdir.join('a.xlsx')))
+    assert not os.path.exists(str(tmpdir.join('b.XLSX')))
+
+
+def put_many(root: str, work_dir: str, worker: int, n: int):
+    store = ArtefactStore(root)
+    for i in range(n):
+        store.put(make_file(os.path.join(work_dir, '{}-{}.xls'.format(worker, i)), b'shared download'))
+        store.record_url('http://example.com/{}/{}'.format(worker, i), 'f.xls', 'blob', [])
+        store.record('T{}'.format(i % 3), [{"blob": 'b{}-{}'.format(worker, i)}])
+
+
+def test_concurrent_writers(tmpdir):
+    root = str(tmpdir.join('store'))
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=put_many, args=(root, str(tmpdir), w, 20)) for w in range(4)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+    assert [p.exitcode for p in workers] == [0] * 4
+    store = ArtefactStore(root)
+    assert len(list(store._blobs())) == 1
+    urls = store._read_json(os.path.join(root, 'urls.json'), {})
+    assert len(urls) == 80
+    assert sum(len(store.snapshots('T{}'.format(t))) for t in range(3)) == 80
+
+
+def test_identical_snapshot_not_recorded_again(tmpdir):
+    store = ArtefactStore(str(tmpdir.join('store')))
+    files = [{"blob": 'x.xlsx', "sheet": None, "skip_row": 1, "last_row": None}]
+    store.record('T', files)
+    store.mark_good('T')
+    store.record('T', [dict(f) for f in files])
+
+    assert len(store.snapshots('T')) == 1
+    assert store.snapshots('T')[0]["good"]
+
+    store.record('T', [{"blob": 'y.xlsx'}])
+    assert [s["good"] for s in store.snapshots('T')] == [False, True]
+
+
+def test_evict_keeps_newest_and_last_good_snapshot(tmpdir):
+    store = ArtefactStore(str(tmpdir.join('store')), budget=0)
+    blobs = [store.put(make_file(str(tmpdir.join('v{}.xlsx'.format(v))), b'version %d' % v)) for v in range(4)]
+    for v, blob in enumerate(blobs):
+        age(blob, 100 - v)
+        store.record('T', [{"blob": blob}])
+        if v == 1:
+            store.mark_good('T')
+    unused = store.put(make_file(str(tmpdir.join('u.xlsx')), b'unused'))
+
+    assert store.pinned() == {blobs[3], blobs[1]}
+    freed = store.evict()
+
+    assert freed == sum(len(b'version %d' % v) for v in (0, 2)) + len(b'unused')
+    assert sorted(store._blobs()) == sorted([blobs[1], blobs[3]])
+    assert not os.path.exists(unused)
+    # snapshots of evicted blobs are dropped
+    assert [s["files"][0]["blob"] for s in store.snapshots('T')] == [blobs[3], blobs[1]]
+
+
+def test_evict_least_recently_used_first(tmpdir):
+    store = ArtefactStore(str(tmpdir.join('store')), budget=20)
+    old = store.put(make_file(str(tmpdir.join('old.xlsx')), b'o' * 10))
+    new = store.put(make_file(str(tmpdir.join('new.xlsx')), b'n' * 10))
+    used = store.put(make_file(str(tmpdir.join('used.xlsx')), b'u' * 10))
+    age(old, 300)
+    age(used, 200)
+    age(new, 100)
+    store.touch(used)
+
+    assert store.evict() == 10
+    assert sorted(store._blobs()) == sorted([new, used])
+
+
+def test_evict_expired(tmpdir):
+    store = ArtefactStore(str(tmpdir.join('store')), max_age=3600)
+    old = store.put(make_file(str(tmpdir.join('old.xlsx')), b'old'))
+    pinned = store.put(make_file(str(tmpdir.join('pinned.xlsx')), b'pinned'))
+    fresh = store.put(make_file(str(tmpdir.join('fresh.xlsx')), b'fresh'))
+    store.record('T', [{"blob": pinned}])
+    age(old, 7200)
+    age(pinned, 7200)
+
+    store.evict()
+    assert sorted(store._blobs()) == sorted([pinned, fresh])
+
+
+def test_stale_lock_is_broken(tmpdir):
+    store = ArtefactStore(str(tmpdir.join('store')), lock_timeout=1)
+    lock_file = make_file(str(tmpdir.join('store', 'manifests.lock')), b'')
+    age(lock_file, 10)
+
+    store.record('T', [{"blob": 'x'}])
+    assert len(store.snapshots('T')) == 1
+    assert not os.path.exists(lock_file)
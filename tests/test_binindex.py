@@ -0,0 +1,29 @@
+import pandas as pd
+
+from crawler.binindex import BinIndex, build_table_index
+
+
+def test_build_lookup_and_rebuild(tmpdir):
+    index_dir = str(tmpdir.join('index'))
+    companies = pd.DataFrame({"BIN": ["123456789012", "010140000123", "", "n/a"],
+                              "owner_IIN": ["880101300123", "", "123456789012", ""]})
+    # leading zero lost, the sheet stored the BIN as a number
+    bankrupt = pd.DataFrame({"BIN": ["10140000123", "123456789012"]})
+
+    assert build_table_index('COMPANIES', companies, index_dir=index_dir) == 4
+    assert build_table_index('BANKRUPT', [bankrupt.iloc[:1], bankrupt.iloc[1:]], index_dir=index_dir) == 2
+
+    idx = BinIndex(index_dir)
+    assert idx.lookup('123456789012') == {"COMPANIES": [('BIN', 0), ('owner_IIN', 2)], "BANKRUPT": [('BIN', 1)]}
+    assert idx.lookup('010140000123') == {"COMPANIES": [('BIN', 1)], "BANKRUPT": [('BIN', 0)]}
+    assert idx.tables(880101300123) == ['COMPANIES']
+    assert idx.lookup('999999999999') == {}
+
+    # reloaded table: only its index changes
+    build_table_index('BANKRUPT', pd.DataFrame({"BIN": ["999999999999"]}), index_dir=index_dir)
+    assert idx.tables('999999999999') == ['BANKRUPT']
+    assert idx.tables('123456789012') == ['COMPANIES']
+
+
+def test_table_without_key_columns(tmpdir):
+    assert build_table_index('OKED', pd.DataFrame({"code": ["01"]}), index_dir=str(tmpdir)) is None
@@ -0,0 +1,132 @@
+import multiprocessing
+import os
+
+import pandas as pd
+import pytest
+
+from crawler.governor import MemoryGovernor, read_rss, read_total_rss
+
+STRUCTURE = ["BIN", "name"]
+MB = 2 ** 20
+
+
+class FakeRss:
+    """rss_func of a process using value bytes"""
+
+    def __init__(self, value: int):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+
+def make_workbook(path: str, sheets: int = 3, rows: int = 200):
+    with pd.ExcelWriter(path) as writer:
+        for s in range(sheets):
+            data = [["БИН", "Наименование"]] + \
+                   [["{:012d}".format(s * rows + r), "ТОО {}".format(r)] for r in range(rows)]
+            pd.DataFrame(data).to_excel(writer, sheet_name='S{}'.format(s), header=False, index=False)
+
+
+@pytest.fixture
+def table_data(tmpdir):
+    path = str(tmpdir.join('big.xlsx'))
+    make_workbook(path)
+    return {"structure": STRUCTURE, "index_col": "BIN", "path": [path], "sheet": [None], "skip_row": [1],
+            "last_row": [None], "store": str(tmpdir.join('store'))}
+
+
+def test_admit_rejects_table_above_headroom(tmpdir, table_data):
+    governor = MemoryGovernor(100 * MB, str(tmpdir.join('history.json')), rss_func=FakeRss(100 * MB))
+    assert not governor.admit('T', table_data)
+
+    governor.rss = FakeRss(10 * MB)
+    assert governor.admit('T', table_data)
+
+
+def test_batch_size_shrinks_under_pressure(tmpdir):
+    rss = FakeRss(10 * MB)
+    governor = MemoryGovernor(100 * MB, str(tmpdir.join('history.json')), small_batch=5000, rss_func=rss)
+    assert governor.batch_size(50000) == 50000
+
+    rss.value = 90 * MB
+    assert governor.batch_size(50000) == 5000
+    assert governor.batch_size(1000) == 1000
+
+
+def test_track_records_admitted_tables_only(tmpdir, table_data):
+    rss = FakeRss(10 * MB)
+    history_file = str(tmpdir.join('history.json'))
+    governor = MemoryGovernor(100 * MB, history_file, rss_func=rss)
+
+    with governor.track('T', table_data, interval=0.01):
+        assert governor.admit('T', table_data)
+        rss.value = 30 * MB
+    assert governor.history["T"]["peak"] == 20 * MB
+    assert MemoryGovernor(100 * MB, history_file).history == governor.history
+
+    rss.value = 100 * MB
+    with governor.track('U', table_data, interval=0.01):
+        assert not governor.admit('U', table_data)
+    assert 'U' not in governor.history
+
+
+def test_process_table_streams_table_above_headroom(crawler, fake_db, tmpdir, table_data):
+    governor = MemoryGovernor(100 * MB, str(tmpdir.join('history.json')), small_batch=5000,
+                              rss_func=FakeRss(100 * MB))
+
+    assert crawler._process_table(fake_db, 'T', table_data, governor=governor)
+
+    assert isinstance(fake_db.data, crawler._StreamedTable)
+    assert fake_db.batch_size == 5000
+    assert len(fake_db.rows) == 600
+    assert 'T' not in governor.history
+
+
+def failing_parse(good_sheets: int):
+    """iter_prepared_data failing after good_sheets sheets"""
+    def iter_prepared_data(table_data, table_name, workbooks=None):
+        for s in range(good_sheets):
+            yield pd.DataFrame({"BIN": ["{:012d}".format(s)], "name": ["ТОО"]})
+        raise ValueError('Bad sheet')
+    return iter_prepared_data
+
+
+def test_streamed_table_first_sheet_parsed_before_purge(crawler, fake_db, monkeypatch, tmpdir, table_data):
+    monkeypatch.setattr(crawler, 'iter_prepared_data', failing_parse(0))
+    governor = MemoryGovernor(100 * MB, str(tmpdir.join('history.json')), rss_func=FakeRss(100 * MB))
+
+    assert not crawler._process_table(fake_db, 'T', table_data, governor=governor)
+
+    assert not fake_db.purged
+
+
+def test_streamed_table_rolled_back_on_later_sheet(crawler, fake_db, monkeypatch, tmpdir, table_data):
+    monkeypatch.setattr(crawler, 'iter_prepared_data', failing_parse(2))
+    governor = MemoryGovernor(100 * MB, str(tmpdir.join('history.json')), rss_func=FakeRss(100 * MB))
+
+    assert not crawler._process_table(fake_db, 'T', table_data, governor=governor)
+
+    assert fake_db.purged
+    assert fake_db.rows == []
+
+
+def hold_memory(size: int, ready, done):
+    block = bytearray(size)
+    ready.set()
+    done.wait(30)
+    return block
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/statm'), reason='needs /proc')
+def test_rss_counts_parse_workers():
+    context = multiprocessing.get_context('spawn')
+    ready, done = context.Event(), context.Event()
+    worker = context.Process(target=hold_memory, args=(200 * MB, ready, done))
+    worker.start()
+    try:
+        assert ready.wait(30)
+        assert read_total_rss() - read_rss() >= 200 * MB
+    finally:
+        done.set()
+        worker.join()
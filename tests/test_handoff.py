@@ -0,0 +1,50 @@
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from crawler.handoff import ParsePool, WorkerLost
+
+STRUCTURE = ["BIN", "name"]
+
+
+class DyingStructure(list):
+    """Structure that kills the parse worker probing it, as the OOM killer would"""
+
+    def index(self, *args):
+        os._exit(9)
+
+
+def make_table(tmpdir, name: str, structure: list):
+    path = str(tmpdir.join(name + '.xlsx'))
+    rows = [["БИН", "Наименование"]] + [["{:012d}".format(r), "ТОО {}".format(r)] for r in range(20)]
+    pd.DataFrame(rows).to_excel(path, header=False, index=False)
+    return {"structure": structure, "index_col": "BIN", "path": [path], "sheet": [None], "skip_row": [1],
+            "last_row": [None], "store": str(tmpdir.join(name))}
+
+
+def test_parse_pool(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    job_queue = {"A": make_table(tmpdir, 'a', STRUCTURE), "B": make_table(tmpdir, 'b', STRUCTURE)}
+
+    with ParsePool(job_queue, workers=2, poll=0.2) as pool:
+        for table_name in job_queue:
+            data = pool.result(table_name)
+            assert len(data) == 20
+            assert list(data.to_pandas()["BIN"])[:2] == ['000000000000', '000000000001']
+            data.close()
+
+
+def test_lost_worker_does_not_hang(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    job_queue = {"DEAD": make_table(tmpdir, 'dead', DyingStructure(STRUCTURE)),
+                 "ALIVE": make_table(tmpdir, 'alive', STRUCTURE)}
+
+    with ParsePool(job_queue, workers=2, poll=0.2) as pool:
+        with pytest.raises(WorkerLost):
+            pool.result("DEAD")
+        data = pool.result("ALIVE")
+        assert len(data) == 20
+        data.close()
@@ -0,0 +1,71 @@
+import pandas as pd
+import pytest
+
+from crawler.queuemanager import prepare_data
+
+STRUCTURE = ["BIN", "name", "region"]
+
+
+def test_empty_and_short_sheets_with_categoricals(tmpdir):
+    path = str(tmpdir.join('b.xlsx'))
+    with pd.ExcelWriter(path) as writer:
+        rows = [["БИН", "Наименование", "Регион"]] + \
+               [["{:012d}".format(r), "ТОО {}".format(r), "Алматы"] for r in range(10)]
+        pd.DataFrame(rows).to_excel(writer, sheet_name='Full', header=False, index=False)
+        # region column missing altogether
+        pd.DataFrame([r[:2] for r in rows]).to_excel(writer, sheet_name='Short', header=False, index=False)
+        pd.DataFrame().to_excel(writer, sheet_name='Empty', header=False, index=False)
+    table_data = {"structure": STRUCTURE, "index_col": "BIN", "path": [path], "sheet": [None],
+                  "skip_row": [1], "last_row": [None], "categorical": ["region"]}
+
+    data = prepare_data(table_data, 'T')
+
+    assert list(data.columns) == STRUCTURE
+    assert len(data) == 20
+    assert str(data["region"].dtype) == 'category'
+    assert list(data["region"]) == ["Алматы"] * 10 + [""] * 10
+
+
+def make_two_sheets(path: str):
+    """Sheet A: 5 rows, a blank row and a footnote; sheet B: 3 rows"""
+    header = [["БИН", "Наименование", "Регион"]]
+    with pd.ExcelWriter(path) as writer:
+        rows = header + [["{:012d}".format(r), "ТОО {}".format(r), "Алматы"] for r in range(5)] + \
+               [[None, None, None], [None, "* по данным на 01.01.2018", None]]
+        pd.DataFrame(rows).to_excel(writer, sheet_name='A', header=False, index=False)
+        rows = header + [["{:012d}".format(r), "ТОО {}".format(r), "Астана"] for r in range(100, 103)]
+        pd.DataFrame(rows).to_excel(writer, sheet_name='B', header=False, index=False)
+
+
+@pytest.fixture
+def two_sheets(tmpdir):
+    path = str(tmpdir.join('two.xlsx'))
+    make_two_sheets(path)
+    return {"structure": STRUCTURE, "index_col": "BIN", "path": [path], "sheet": [None],
+            "skip_row": [1], "last_row": [None]}
+
+
+def test_blank_row_ends_only_its_own_sheet(two_sheets):
+    data = prepare_data(two_sheets, 'T')
+
+    # the whole table used to end at the first blank BIN, dropping sheet B
+    assert list(data["BIN"]) == ["{:012d}".format(r) for r in list(range(5)) + list(range(100, 103))]
+
+
+def test_read_past_blank_rows(two_sheets):
+    two_sheets["stop_at_blank"] = False
+
+    data = prepare_data(two_sheets, 'T')
+
+    assert len(data) == 5 + 2 + 3
+    assert list(data["name"][5:7]) == ["", "* по данным на 01.01.2018"]
+    assert list(data["BIN"][7:]) == ["{:012d}".format(r) for r in range(100, 103)]
+
+
+def test_last_row(two_sheets):
+    # spreadsheet rows 2 to 4 of every sheet of the source
+    two_sheets["last_row"] = [4]
+
+    data = prepare_data(two_sheets, 'T')
+
+    assert list(data["BIN"]) == ["{:012d}".format(r) for r in [0, 1, 2, 100, 101, 102]]
@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+from crawler.probe import SchemaMismatch, probe_table
+
+STRUCTURE = ["BIN", "name", "region"]
+
+
+def _workbook(path: str):
+    """Two data sheets with a header row and an empty third sheet"""
+    with pd.ExcelWriter(path) as writer:
+        for s in range(2):
+            rows = [["БИН", "Наименование", "Регион"]] + \
+                   [["{:012d}".format(s * 10 + r), "ТОО {}".format(r), "Алматы"] for r in range(10)]
+            pd.DataFrame(rows).to_excel(writer, sheet_name='S{}'.format(s), header=False, index=False)
+        pd.DataFrame().to_excel(writer, sheet_name='Empty', header=False, index=False)
+
+
+def _table_data(path: str, sheet):
+    return {"structure": STRUCTURE, "index_col": "BIN", "path": [path], "sheet": [sheet], "skip_row": [1]}
+
+
+def test_empty_sheet_skipped_when_reading_all_sheets(tmpdir):
+    path = str(tmpdir.join('b.xlsx'))
+    _workbook(path)
+    fingerprints = str(tmpdir.join('fingerprints'))
+
+    probe_table(_table_data(path, None), 'T', fingerprint_dir=fingerprints)
+    # compared with the stored fingerprint on the next run
+    probe_table(_table_data(path, None), 'T', fingerprint_dir=fingerprints)
+
+
+def test_selected_empty_sheet_rejected(tmpdir):
+    path = str(tmpdir.join('b.xlsx'))
+    _workbook(path)
+
+    with pytest.raises(SchemaMismatch):
+        probe_table(_table_data(path, 'Empty'), 'T', fingerprint_dir=str(tmpdir.join('fingerprints')))
@@ -0,0 +1,69 @@
+import pandas as pd
+import pytest
+
+STRUCTURE = ["BIN", "name"]
+
+
+@pytest.fixture
+def table_data(tmpdir):
+    path = str(tmpdir.join('t.xlsx'))
+    rows = [["БИН", "Наименование"]] + [["{:012d}".format(r), "ТОО {}".format(r)] for r in range(20)]
+    pd.DataFrame(rows).to_excel(path, header=False, index=False)
+    return {"structure": STRUCTURE, "index_col": "BIN", "path": [path], "sheet": [None], "skip_row": [1],
+            "last_row": [None], "store": str(tmpdir.join('store'))}
+
+
+def test_table_not_cleared_is_not_loaded(crawler, fake_db, table_data):
+    fake_db.purge_error = RuntimeError('ORA-00054: resource busy')
+
+    assert not crawler._process_table(fake_db, 'T', table_data)
+    assert fake_db.loads == 0
+
+
+def test_purge_raises_database_errors():
+    pytest.importorskip('cx_Oracle')
+    from crawler.dbfill import DbFill
+
+    class Cursor:
+        def execute(self, sql):
+            raise RuntimeError('ORA-02266: unique/primary keys in table referenced by enabled foreign keys')
+
+    class Connection:
+        def cursor(self):
+            return Cursor()
+
+    db = DbFill.__new__(DbFill)
+    db._oracle_conn = Connection()
+    with pytest.raises(RuntimeError):
+        db.purge('T')
+
+
+def test_table_of_lost_parse_worker_parsed_in_process(crawler, fake_db, table_data):
+    class LostPool:
+        def __contains__(self, table_name):
+            return True
+
+        def result(self, table_name):
+            raise crawler.WorkerLost('{}: Parse worker died'.format(table_name))
+
+    assert crawler._process_table(fake_db, 'T', table_data, parse_pool=LostPool())
+    assert len(fake_db.rows) == 20
+
+
+def test_table_resumed_after_loading_is_indexed(crawler, fake_db, table_data, tmpdir):
+    from crawler.binindex import BinIndex
+    from crawler.dbfill import LoadChecksum
+    from crawler.journal import RunJournal
+    from crawler.queuemanager import prepare_data
+
+    parsed_file = str(tmpdir.join('parsed.pkl'))
+    prepare_data(table_data, 'T').to_pickle(parsed_file)
+    checksum = LoadChecksum(STRUCTURE)
+    checksum.rows = 20
+    journal = RunJournal()
+    journal.mark('T', 'parsed', file=parsed_file, rows=20)
+    journal.mark('T', 'loaded', rows=20, checksum=checksum.to_dict())
+
+    assert crawler._process_table(fake_db, 'T', table_data, journal)
+    assert fake_db.loads == 0
+    assert BinIndex().tables('000000000019') == ['T']
@@ -0,0 +1,149 @@
+import os
+
+import pandas as pd
+import pytest
+
+import crawler.queuemanager as qm
+from crawler.journal import RunJournal
+from crawler.queuemanager import download_extract_files, prepare_data
+
+STRUCTURE = ["BIN", "name"]
+
+
+@pytest.fixture
+def table_data(tmpdir):
+    path = str(tmpdir.join('t.xlsx'))
+    rows = [["БИН", "Наименование"]] + [["{:012d}".format(r), "ТОО {}".format(r)] for r in range(20)]
+    pd.DataFrame(rows).to_excel(path, header=False, index=False)
+    return {"structure": STRUCTURE, "index_col": "BIN", "path": [path], "sheet": [None], "skip_row": [1],
+            "last_row": [None], "store": str(tmpdir.join('store')), "urls": ['http://example.com/t.xlsx']}
+
+
+@pytest.fixture
+def no_parse(crawler, monkeypatch):
+    """Fail any attempt of process_table to parse the spreadsheets again"""
+    def fail(*args, **kwargs):
+        raise AssertionError('parsed again')
+    monkeypatch.setattr(crawler, 'prepare_data', fail)
+    monkeypatch.setattr(crawler, 'probe_table', fail)
+
+
+def loaded_checksum(rows: int):
+    from crawler.dbfill import LoadChecksum
+    checksum = LoadChecksum(STRUCTURE)
+    checksum.rows = rows
+    return checksum.to_dict()
+
+
+def test_parsed_pickle_is_reused(crawler, no_parse, fake_db, table_data, tmpdir):
+    parsed_file = str(tmpdir.join('.parsed.pkl'))
+    prepare_data(table_data, 'T').to_pickle(parsed_file)
+    journal = RunJournal()
+    journal.mark('T', 'parsed', file=parsed_file, rows=20)
+
+    assert crawler._process_table(fake_db, 'T', table_data, journal)
+
+    assert fake_db.rows == ["{:012d}".format(r) for r in range(20)]
+    assert journal.done('T', 'verified')
+    assert journal.artefacts('T', 'loaded')["rows"] == 20
+    # the parsed copy is only kept until the table is verified
+    assert not os.path.exists(parsed_file)
+
+
+def test_parsed_arrow_file_is_reused(crawler, no_parse, fake_db, table_data, tmpdir):
+    pytest.importorskip('pyarrow')
+    from crawler.handoff import write_arrow
+    parsed_file = write_arrow(prepare_data(table_data, 'T'), str(tmpdir.join('.parsed.arrow')), batch_size=8)
+    journal = RunJournal()
+    journal.mark('T', 'parsed', file=parsed_file, rows=20)
+
+    assert crawler._process_table(fake_db, 'T', table_data, journal)
+
+    assert len(fake_db.rows) == 20
+    assert journal.done('T', 'verified')
+    assert not os.path.exists(parsed_file)
+
+
+def test_missing_parsed_file_is_parsed_again(crawler, fake_db, table_data, tmpdir):
+    journal = RunJournal()
+    journal.mark('T', 'parsed', file=str(tmpdir.join('gone.pkl')), rows=20)
+
+    assert crawler._process_table(fake_db, 'T', table_data, journal)
+    assert len(fake_db.rows) == 20
+
+
+def test_loaded_table_is_only_verified(crawler, no_parse, fake_db, monkeypatch, table_data):
+    monkeypatch.setattr(crawler, 'get_settings', lambda section, **defaults: dict(defaults, mode='checksum'))
+    verified = []
+    fake_db.verify_checksum = lambda table_name, checksum: verified.append(checksum.rows) or True
+    journal = RunJournal()
+    journal.mark('T', 'loaded', rows=20, checksum=loaded_checksum(20))
+
+    assert crawler._process_table(fake_db, 'T', table_data, journal)
+
+    assert fake_db.loads == 0
+    assert not fake_db.purged
+    assert verified == [20]
+    assert journal.done('T', 'verified')
+
+
+def test_mismatch_resets_loaded_stage(crawler, no_parse, fake_db, table_data, tmpdir):
+    parsed_file = str(tmpdir.join('.parsed.pkl'))
+    prepare_data(table_data, 'T').to_pickle(parsed_file)
+    journal = RunJournal()
+    journal.mark('T', 'parsed', file=parsed_file, rows=20)
+    journal.mark('T', 'loaded', rows=20, checksum=loaded_checksum(19))
+
+    assert not crawler._process_table(fake_db, 'T', table_data, journal)
+
+    # reloaded from the parsed copy on the next --resume
+    assert not journal.done('T', 'loaded')
+    assert journal.done('T', 'parsed')
+    assert os.path.exists(parsed_file)
+
+    resumed = RunJournal(resume=True)
+    assert crawler._process_table(fake_db, 'T', table_data, resumed)
+    assert fake_db.loads == 1
+    assert resumed.done('T', 'verified')
+
+
+def test_verified_table_is_skipped(crawler, no_parse, fake_db, table_data):
+    journal = RunJournal()
+    journal.mark('T', 'verified', rows=20)
+
+    assert crawler._process_table(fake_db, 'T', table_data, journal)
+    assert fake_db.loads == 0
+    assert not fake_db.purged
+
+
+def test_extracted_table_is_not_downloaded(monkeypatch, table_data, tmpdir):
+    monkeypatch.chdir(str(tmpdir))
+    downloads = []
+    monkeypatch.setattr(qm, 'retrieve_file_object', lambda url, *args: downloads.append(url))
+    journal = RunJournal()
+    journal.mark('T', 'extracted', path=table_data["path"], sheet=[0], skip_row=[1], last_row=[21])
+    job_queue = {"T": dict(table_data, path=[], sheet=[None], last_row=[None])}
+
+    job_queue = download_extract_files(job_queue, journal=journal)
+
+    assert downloads == []
+    assert job_queue["T"]["path"] == table_data["path"]
+    assert job_queue["T"]["sheet"] == [0]
+    assert job_queue["T"]["last_row"] == [21]
+
+
+def test_extracted_files_gone_are_downloaded_again(monkeypatch, table_data, tmpdir):
+    monkeypatch.chdir(str(tmpdir))
+    downloads = []
+
+    def retrieve_file_object(url, *args):
+        downloads.append(url)
+        raise IOError('offline')
+    monkeypatch.setattr(qm, 'retrieve_file_object', retrieve_file_object)
+    journal = RunJournal()
+    journal.mark('T', 'extracted', path=[str(tmpdir.join('gone.xlsx'))], sheet=[None], skip_row=[1],
+                 last_row=[None])
+
+    with pytest.raises(IOError):
+        download_extract_files({"T": dict(table_data, path=[])}, journal=journal)
+    assert downloads == table_data["urls"]
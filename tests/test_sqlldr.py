@@ -0,0 +1,119 @@
+import logging
+import os
+
+import pandas as pd
+import pytest
+
+from crawler.sqlldr import SqlLoader, format_userid, render_control_file, write_data_file
+
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), 'golden')
+
+STRUCTURE = ["BIN", "name_kz", "note"]
+# Kazakh letters, quotes, a newline and backslashes
+FRAME = pd.DataFrame({"BIN": ["123456789012", "987654321098"],
+                      "name_kz": ['"Қазақстан" ЖШС', 'Әлем\\Ұлы'],
+                      "note": ['say "hi"\nnext line', 'C:\\temp, ok']})
+# FRAME as encoded by DbFill._kaz_encode_frame
+ENCODED_ROWS = [("123456789012", '"\\049aаза\\049bстан" ЖШС', 'say "hi"\nnext line'),
+                ("987654321098", '\\04d8лем//\\04b0лы', 'C://temp, ok')]
+
+DSN = '(DESCRIPTION=(ADDRESS=(PROTOCOL=TCP)(HOST=db)(PORT=1521))(CONNECT_DATA=(SID=ORCL)))'
+
+
+def golden(name: str):
+    with open(os.path.join(GOLDEN_DIR, name), 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def read(path: str):
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def test_data_file_matches_golden(tmpdir):
+    path = str(tmpdir.join('T.dat'))
+    rows, max_len = write_data_file([ENCODED_ROWS], path)
+
+    assert rows == 2
+    assert max_len == [12, len(ENCODED_ROWS[0][1].encode('utf-8')), 18]
+    assert read(path) == golden('T.dat')
+
+
+def test_control_file_matches_golden():
+    assert render_control_file('T', STRUCTURE, ["name_kz"], 'T.dat', [12, 33, 18]) == golden('T.ctl')
+
+
+def test_parfile_quotes_userid(tmpdir):
+    control_file = str(tmpdir.join('T.ctl'))
+    parfiles = []
+
+    def runner(args):
+        parfile = args[1][len('parfile='):]
+        parfiles.append((oct(os.stat(parfile).st_mode & 0o777), read(parfile)))
+        return 0, ''
+
+    SqlLoader(runner=runner).load(control_file, format_userid('crawler', 'p@ss word', DSN))
+
+    assert parfiles == [('0o600', 'userid="crawler/\\"p@ss word\\"@\\"{}\\""\n'.format(DSN))]
+    assert not os.path.exists(str(tmpdir.join('T.par')))
+
+
+def test_failed_load(tmpdir):
+    assert SqlLoader(runner=lambda args: (1, 'SQL*Loader-350: Syntax error')).load(
+        str(tmpdir.join('T.ctl')), format_userid('crawler', 'secret', DSN)) is None
+
+
+def test_load_removes_log_files(tmpdir):
+    control_file = str(tmpdir.join('T.ctl'))
+    runner = canned_run(2)
+
+    def run_with_bad_file(args):
+        open(args[4][len('bad='):], 'w').close()
+        return runner(args)
+
+    assert SqlLoader(runner=run_with_bad_file).load(control_file, format_userid('crawler', 'secret', DSN)) == 2
+    assert tmpdir.listdir() == []
+
+
+def canned_run(rows: int):
+    """SqlLoader runner writing the log of a successful sqlldr run"""
+    def runner(args):
+        log_file = args[3][len('log='):]
+        with open(log_file, 'w') as f:
+            f.write('Table T:\n  {} Rows successfully loaded.\n  0 Rows not loaded due to data errors.\n'.format(rows))
+        return 0, ''
+    return runner
+
+
+@pytest.fixture
+def db():
+    pytest.importorskip('cx_Oracle')
+    from crawler.dbfill import DbFill
+    db = DbFill.__new__(DbFill)
+    db._logger = logging.getLogger('DbFill')
+    db._conn_oracle_sett = {"user": "crawler", "password": "secret"}
+    db._dsn = DSN
+    return db
+
+
+def test_bulk_load_matches_golden(tmpdir, db):
+    work_dir = str(tmpdir.join('load'))
+    loader = SqlLoader(runner=canned_run(2), keep_files=True)
+
+    checksum = db.bulk_load('T', STRUCTURE, FRAME, work_dir, loader=loader)
+
+    assert checksum.rows == 2
+    assert checksum.lengths == {"BIN": 24, "name_kz": 24, "note": 30}
+    assert read(os.path.join(work_dir, 'T.dat')) == golden('T.dat')
+    assert read(os.path.join(work_dir, 'T.ctl')).replace(os.path.join(work_dir, ''), '') == golden('T.ctl')
+    assert os.path.exists(os.path.join(work_dir, 'T.log'))
+
+
+def test_bulk_load_reports_rows_from_log(tmpdir, db):
+    work_dir = str(tmpdir.join('load'))
+
+    checksum = db.bulk_load('T', STRUCTURE, FRAME, work_dir, loader=SqlLoader(runner=canned_run(1)))
+
+    # a short load shows up as a row count mismatch in _process_table
+    assert checksum.rows == 1
+    assert os.listdir(work_dir) == []
@@ -0,0 +1,98 @@
+"""
+Claim queue shared by several local worker processes.
+
+    $ python -m pytest tests/test_workqueue.py
+"""
+import json
+import multiprocessing
+import os
+from time import sleep, time
+
+from crawler.workqueue import ClaimQueue
+
+
+def _worker(queue_dir: str, lease: float, log_dir: str):
+    """Claim and complete items until nothing is left, logging every item processed"""
+    queue = ClaimQueue(queue_dir, lease=lease)
+    with open(os.path.join(log_dir, queue.worker_id), 'w') as log:
+        while True:
+            item = queue.claim()
+            if item is None:
+                if not queue.has_claims():
+                    return
+                sleep(0.05)
+                continue
+            table, _ = item
+            with queue.keep_alive(table):
+                log.write(table + '\n')
+                log.flush()
+                sleep(0.001)
+            queue.complete(table)
+
+
+def _crashing_worker(queue_dir: str, lease: float, claimed):
+    """Claim one item, then hang without heartbeat until killed"""
+    item = ClaimQueue(queue_dir, lease=lease).claim()
+    claimed.put(item[0])
+    sleep(3600)
+
+
+def _run_workers(queue_dir: str, lease: float, log_dir: str, n: int):
+    workers = [multiprocessing.Process(target=_worker, args=(queue_dir, lease, log_dir)) for _ in range(n)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join(timeout=120)
+    return workers
+
+
+def _processed(log_dir: str):
+    tables = []
+    for f in os.listdir(log_dir):
+        with open(os.path.join(log_dir, f), 'r') as log:
+            tables.extend(line.strip() for line in log if line.strip())
+    return tables
+
+
+def _publish(queue_dir: str, n_items: int):
+    tables = ['T{:04d}'.format(i) for i in range(n_items)]
+    ClaimQueue(queue_dir).publish({t: {"structure": ["BIN"]} for t in tables})
+    return tables
+
+
+def test_every_item_done_exactly_once(tmpdir):
+    queue_dir, log_dir = str(tmpdir.join('queue')), str(tmpdir.mkdir('logs'))
+    tables = _publish(queue_dir, 1000)
+    # published long before the workers start: pending files older than the lease
+    old = time() - 60
+    for f in os.listdir(os.path.join(queue_dir, 'pending')):
+        os.utime(os.path.join(queue_dir, 'pending', f), (old, old))
+
+    workers = _run_workers(queue_dir, lease=2, log_dir=log_dir, n=8)
+
+    assert [w.exitcode for w in workers] == [0] * 8
+    processed = _processed(log_dir)
+    assert sorted(processed) == tables
+    assert sorted(os.path.splitext(f)[0] for f in os.listdir(os.path.join(queue_dir, 'done'))) == tables
+    for state in ('pending', 'claimed', 'failed'):
+        assert os.listdir(os.path.join(queue_dir, state)) == []
+
+
+def test_killed_worker_item_is_reclaimed(tmpdir):
+    queue_dir, log_dir = str(tmpdir.join('queue')), str(tmpdir.mkdir('logs'))
+    tables = _publish(queue_dir, 20)
+    claimed = multiprocessing.Queue()
+    crashing = multiprocessing.Process(target=_crashing_worker, args=(queue_dir, 1, claimed))
+    crashing.start()
+    lost = claimed.get(timeout=30)
+    crashing.kill()
+    crashing.join()
+
+    workers = _run_workers(queue_dir, lease=1, log_dir=log_dir, n=3)
+
+    assert [w.exitcode for w in workers] == [0] * 3
+    processed = _processed(log_dir)
+    assert processed.count(lost) == 1
+    assert sorted(processed) == tables
+    with open(os.path.join(queue_dir, 'done', lost + '.json'), 'r') as f:
+        assert lost in json.load(f)